@@ -0,0 +1,178 @@
+
+from __future__ import print_function, division
+
+"""
+On disk cache of pipeline stage results
+
+Results are stored under a hash of everything that went into them:
+parameters (e.g. the .par values), yml subtrees, the identity of the
+input files (path, size, modification time) and the source code of
+the stage function. Each result is a dict of numpy arrays saved as
+an .npz file. Old entries are removed, least recently used first,
+when the folder goes over a size or count limit.
+
+    c = cache.stagecache( "/tmp/grewgg_cache", maxbytes = 2**30 )
+    geometry = cache.ymltree( "fable.yml", ["Positioners", "Fable_detector"] )
+    xyz = c.run( compute_xyz, args = ( pars, geometry ),
+                 files = [ "peaks.flt" ] )['xyz']
+"""
+
+import os, json, hashlib, inspect, tempfile
+import numpy as np
+
+
+def fileid( filename ):
+    """ Identity of an input file, changes if the file is rewritten """
+    st = os.stat( filename )
+    return { 'file' : os.path.abspath( filename ),
+             'size' : st.st_size,
+             'mtime' : st.st_mtime_ns }
+
+
+def ymltree( ymlfile, path ):
+    """ The part of a yml file a stage depends on (e.g. one positioner
+    stack), so edits elsewhere in the file do not invalidate results """
+    import yaml
+    with open( ymlfile, "r" ) as f:
+        tree = yaml.safe_load( f )
+    for name in path:
+        tree = tree[name]
+    return tree
+
+
+def _canonical( obj, h ):
+    """ Feed obj into the hash h in a repeatable way """
+    if isinstance( obj, dict ):
+        h.update( b"{" )
+        for k in sorted( obj, key=str ):
+            _canonical( str(k), h )
+            _canonical( obj[k], h )
+        h.update( b"}" )
+    elif isinstance( obj, ( list, tuple ) ):
+        h.update( b"[" )
+        for item in obj:
+            _canonical( item, h )
+        h.update( b"]" )
+    elif isinstance( obj, np.ndarray ):
+        a = np.ascontiguousarray( obj )
+        h.update( ( "array%s%s"%( a.dtype.str, a.shape ) ).encode() )
+        h.update( a.tobytes() )
+    elif isinstance( obj, np.generic ):
+        _canonical( obj.item(), h )
+    else:
+        h.update( json.dumps( obj ).encode() )
+
+
+def code_version( func ):
+    """ Hash of the source of a stage function """
+    try:
+        src = inspect.getsource( func )
+    except ( IOError, TypeError, OSError ):
+        src = getattr( func, "__qualname__", repr( func ) )
+    return hashlib.sha1( src.encode() ).hexdigest()
+
+
+_package_version = []
+
+def package_version():
+    """ Hash of the grewgg sources, so results are redone after changes """
+    if not _package_version:
+        h = hashlib.sha1()
+        here = os.path.dirname( os.path.abspath( __file__ ) )
+        for name in sorted( os.listdir( here ) ):
+            if name.endswith( ".py" ):
+                with open( os.path.join( here, name ), "rb" ) as f:
+                    h.update( f.read() )
+        _package_version.append( h.hexdigest() )
+    return _package_version[0]
+
+
+def key( *inputs, **named ):
+    """ Hash of the inputs of a stage """
+    h = hashlib.sha1()
+    _canonical( [ list( inputs ), named ], h )
+    return h.hexdigest()
+
+
+class stagecache( object ):
+    """ Folder of .npz results, keyed by the hash of their inputs """
+    def __init__( self, folder, maxbytes=None, maxentries=None ):
+        self.folder = folder
+        self.maxbytes = maxbytes
+        self.maxentries = maxentries
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir( folder ):
+            os.makedirs( folder )
+
+    def path( self, k ):
+        return os.path.join( self.folder, k + ".npz" )
+
+    def get( self, k ):
+        """ The stored dict of arrays, or None """
+        fname = self.path( k )
+        try:
+            with np.load( fname, allow_pickle=False ) as npz:
+                result = dict( ( name, npz[name] ) for name in npz.files )
+        except ( IOError, OSError, ValueError ):
+            self.misses += 1
+            return None
+        os.utime( fname, None ) # mark as recently used
+        self.hits += 1
+        return result
+
+    def put( self, k, arrays ):
+        """ Store a dict of arrays, then evict if over the limits """
+        fd, tmp = tempfile.mkstemp( dir=self.folder, suffix=".tmp" )
+        with os.fdopen( fd, "wb" ) as f:
+            np.savez( f, **arrays )
+        os.replace( tmp, self.path( k ) )
+        self.evict()
+
+    def entries( self ):
+        """ (mtime, size, path) for each entry, oldest first """
+        found = []
+        for name in os.listdir( self.folder ):
+            if name.endswith( ".npz" ):
+                fname = os.path.join( self.folder, name )
+                try:
+                    st = os.stat( fname )
+                except OSError:
+                    continue
+                found.append( ( st.st_mtime, st.st_size, fname ) )
+        found.sort()
+        return found
+
+    def evict( self ):
+        """ Remove least recently used entries to meet the limits """
+        if self.maxbytes is None and self.maxentries is None:
+            return
+        found = self.entries()
+        total = sum( [ size for _, size, _ in found ] )
+        while found and ( ( self.maxbytes is not None and
+                            total > self.maxbytes ) or
+                          ( self.maxentries is not None and
+                            len( found ) > self.maxentries ) ):
+            _, size, fname = found.pop( 0 )
+            try:
+                os.remove( fname )
+            except OSError:
+                pass
+            total -= size
+
+    def run( self, stage, args=(), kwds=None, files=() ):
+        """
+        Returns stage( *args, **kwds ) from the cache if it was already
+        computed with the same arguments, input files and code.
+        files : input filenames, their identities go into the key
+        The stage must return a dict of numpy arrays.
+        """
+        kwds = kwds or {}
+        k = key( stage.__module__, stage.__name__, code_version( stage ),
+                 package_version(), list( args ), kwds,
+                 [ fileid( f ) for f in files ] )
+        result = self.get( k )
+        if result is None:
+            result = stage( *args, **kwds )
+            self.put( k, result )
+        return result
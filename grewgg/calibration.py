@@ -0,0 +1,235 @@
+
+from __future__ import print_function, division
+
+"""
+Detector calibration from the powder rings of a known cell
+
+The cell, lattice centring and wavelength come from the fable pars.
+Any subset of the parameters of a detector stack (distance, tilts,
+centre, pixel sizes, the o11..o22 flips) can be refined. Each peak
+is assigned to the nearest ring within fit_tolerance (degrees) and
+the residual is the difference in two theta.
+
+The detector stack is built once. For the Jacobian all of the
+stepped parameter sets go through instrument.batch at once, so each
+Levenberg-Marquardt iteration is one vectorised pass over the peaks
+(in blocks, to bound the memory for 10^6 peaks).
+
+    cal = calibration.calibration( pars, sc, fc,
+                                   [ 'distance', 'y_center', 'z_center',
+                                     'tilt_y', 'tilt_z' ] )
+    cal.fit()
+    print( cal.pars, cal.errors )
+"""
+
+import numpy as np
+from . import general_geometry, errors
+
+
+CELL_KEYS = [ "cell__a", "cell__b", "cell__c",
+              "cell_alpha", "cell_beta", "cell_gamma" ]
+
+LATTICE_KEYS = [ "cell_lattice_[P,A,B,C,I,F,R]", "cell_lattice_[P,A,B,C,I,F]" ]
+
+
+def allowed( h, k, l, lattice ):
+    """ Reflection conditions for the lattice centring """
+    if lattice == 'P':
+        return np.ones( h.shape, bool )
+    if lattice == 'A':
+        return ( k + l ) % 2 == 0
+    if lattice == 'B':
+        return ( h + l ) % 2 == 0
+    if lattice == 'C':
+        return ( h + k ) % 2 == 0
+    if lattice == 'I':
+        return ( h + k + l ) % 2 == 0
+    if lattice == 'F':
+        return ( ( h + k ) % 2 == 0 ) & ( ( h + l ) % 2 == 0 )
+    if lattice == 'R':
+        return ( -h + k + l ) % 3 == 0
+    raise ValueError( "Unknown lattice " + str( lattice ) )
+
+
+def ring_tth( pars, tthmax ):
+    """ Sorted unique two theta (degrees) of the rings up to tthmax """
+    a, b, c, al, be, ga = [ float( pars[k] ) for k in CELL_KEYS ]
+    lattice = 'P'
+    for k in LATTICE_KEYS:
+        if k in pars:
+            lattice = str( pars[k] )
+            break
+    ca, cb, cg = np.cos( np.radians( [ al, be, ga ] ) )
+    g = np.array( [ [ a*a,    a*b*cg, a*c*cb ],
+                    [ a*b*cg, b*b,    b*c*ca ],
+                    [ a*c*cb, b*c*ca, c*c    ] ] )
+    gi = np.linalg.inv( g )
+    wvln = float( pars['wavelength'] )
+    dsmax = 2 * np.sin( np.radians( tthmax ) / 2 ) / wvln
+    # hmax along each axis from the d spacing of the planes
+    hmax = [ int( np.floor( dsmax / np.sqrt( gi[i,i] ) ) ) + 1
+             for i in range(3) ]
+    h, k, l = np.mgrid[ -hmax[0]:hmax[0]+1,
+                        -hmax[1]:hmax[1]+1,
+                        -hmax[2]:hmax[2]+1 ].reshape( 3, -1 )
+    hkl = np.array( [ h, k, l ], float )
+    ds2 = ( hkl * np.dot( gi, hkl ) ).sum( axis=0 )
+    keep = allowed( h, k, l, lattice ) & ( ds2 > 0 ) & ( ds2 <= dsmax**2 )
+    ds = np.unique( np.round( np.sqrt( ds2[keep] ), 10 ) )
+    return np.degrees( 2 * np.arcsin( ds * wvln / 2 ) )
+
+
+def lab_tth( xyz, origin=None ):
+    """ Two theta (degrees) of (...,3,N) lab vectors, beam along x """
+    if origin is not None:
+        xyz = xyz - origin
+    r = np.sqrt( ( xyz * xyz ).sum( axis=-2 ) )
+    return np.degrees( np.arccos( np.clip( xyz[..., 0, :] / r, -1, 1 ) ) )
+
+
+class calibration( object ):
+    """ Fit detector parameters to the rings of a calibrant """
+    def __init__( self, pars, sc, fc, free, ymlfile=None,
+                  path=( "Positioners", "Fable_detector" ),
+                  tolerance=None, blocksize=2**18 ):
+        """
+        pars : fable parameters, with the cell and wavelength
+        sc, fc : peak positions on the detector
+        free : names of the parameters to refine
+        tolerance : ring assignment in degrees (default fit_tolerance)
+        """
+        if ymlfile is None:
+            ymlfile = general_geometry.FABLE_YML
+        self.pars = dict( pars )
+        self.free = list( free )
+        self.detector = general_geometry.from_yml( self.pars, ymlfile,
+                                                   list( path ) )
+        for name in self.free:
+            if name not in self.detector.depends:
+                raise KeyError( "%s is not a detector parameter"%( name ) )
+        sc = np.asarray( sc, float )
+        fc = np.asarray( fc, float )
+        self.v = np.array( [ np.zeros_like( sc ), fc, sc ] )
+        if tolerance is None:
+            tolerance = float( self.pars.get( 'fit_tolerance', 0.2 ) )
+        self.tolerance = tolerance
+        self.blocksize = blocksize
+        self.cov = None
+        self.errors = {}
+        self.assign()
+
+    def values( self ):
+        return np.array( [ float( self.pars[name] ) for name in self.free ] )
+
+    def tth( self, batch=None, i0=0, i1=None ):
+        """ (K,n) two theta of the peaks i0:i1 for K parameter sets """
+        if batch is None:
+            batch = { self.free[0] : [ self.pars[ self.free[0] ] ] }
+        return lab_tth( self.detector.batch( self.v[:, i0:i1], batch ) )
+
+    def assign( self ):
+        """ Nearest ring to each peak, within tolerance """
+        tth = self.tth()[0]
+        self.rings = ring_tth( self.pars, tth.max() + self.tolerance )
+        if len( self.rings ) == 0:
+            self.ring = np.full( tth.shape, np.nan )
+            self.mask = np.zeros( tth.shape, bool )
+            return
+        i = np.searchsorted( self.rings, tth )
+        last = len( self.rings ) - 1
+        lo = self.rings[ np.clip( i - 1, 0, last ) ]
+        hi = self.rings[ np.clip( i, 0, last ) ]
+        self.ring = np.where( np.abs( tth - lo ) < np.abs( hi - tth ), lo, hi )
+        self.mask = np.abs( tth - self.ring ) < self.tolerance
+
+    def _batch( self, p, steps=None ):
+        """ Parameter sets: p, then p with each parameter stepped """
+        K = 1 if steps is None else len( p ) + 1
+        batch = {}
+        for j, name in enumerate( self.free ):
+            batch[name] = np.full( K, p[j] )
+            if steps is not None:
+                batch[name][j + 1] += steps[j]
+        return batch
+
+    def residuals( self, p ):
+        """ Two theta residuals of the assigned peaks for parameters p """
+        batch = self._batch( p )
+        r = []
+        for i0 in range( 0, self.v.shape[1], self.blocksize ):
+            i1 = i0 + self.blocksize
+            m = self.mask[i0:i1]
+            r.append( ( self.tth( batch, i0, i1 )[0] - self.ring[i0:i1] )[m] )
+        return np.concatenate( r )
+
+    def normal( self, p, steps ):
+        """ J^T J, J^T r, chi^2 and n accumulated over blocks of peaks """
+        batch = self._batch( p, steps )
+        npar = len( p )
+        JtJ = np.zeros( (npar, npar) )
+        Jtr = np.zeros( npar )
+        chi2 = 0.
+        n = 0
+        for i0 in range( 0, self.v.shape[1], self.blocksize ):
+            i1 = i0 + self.blocksize
+            m = self.mask[i0:i1]
+            tth = self.tth( batch, i0, i1 )[:, m]
+            r = tth[0] - self.ring[i0:i1][m]
+            J = ( tth[1:] - tth[0] ) / steps[:, np.newaxis]  # (P,n)
+            JtJ += np.dot( J, J.T )
+            Jtr += np.dot( J, r )
+            chi2 += np.dot( r, r )
+            n += len( r )
+        return JtJ, Jtr, chi2, n
+
+    def _refine( self, p, maxiter, lam, tol ):
+        """ Levenberg-Marquardt from p with the current assignment """
+        steps = 1e-6 * np.maximum( np.abs( p ), 1.0 )
+        JtJ, Jtr, chi2, n = self.normal( p, steps )
+        for it in range( maxiter ):
+            A = JtJ + lam * np.diag( np.diag( JtJ ) )
+            try:
+                dp = -np.linalg.solve( A, Jtr )
+            except np.linalg.LinAlgError:
+                dp = -np.dot( np.linalg.pinv( A ), Jtr )
+            r = self.residuals( p + dp )
+            new = np.dot( r, r )
+            if new < chi2:
+                p = p + dp
+                lam = lam / 10
+                done = chi2 - new <= tol * chi2
+                steps = 1e-6 * np.maximum( np.abs( p ), 1.0 )
+                JtJ, Jtr, chi2, n = self.normal( p, steps )
+                if done:
+                    break
+            else:
+                lam = lam * 10
+                if lam > 1e10:
+                    break
+        return p, JtJ, chi2, n
+
+    def fit( self, maxiter=50, lam=1e-3, tol=1e-10, reassign=10 ):
+        """
+        Levenberg-Marquardt refinement of the free parameters
+        The peaks are assigned to rings again after each refinement and
+        refined again until the assignment stops changing (at most
+        reassign times), so the errors come from the final assignment
+        """
+        p = self.values()
+        for cycle in range( reassign + 1 ):
+            p, JtJ, chi2, n = self._refine( p, maxiter, lam, tol )
+            self.pars.update( zip( self.free, p ) )
+            self.detector.update( dict( zip( self.free, p ) ) )
+            if cycle == reassign:
+                break
+            ring, mask = self.ring, self.mask
+            self.assign()
+            if np.array_equal( mask, self.mask ) and \
+               np.array_equal( ring[mask], self.ring[mask] ):
+                break
+        self.cov = errors.covariance_normal( JtJ, chi2, n )
+        self.errors = dict( zip( self.free,
+                                 errors.uncertainties( self.cov ) ) )
+        self.chi2 = chi2
+        self.npeaks = n
+        return self.pars
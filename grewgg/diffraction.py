@@ -0,0 +1,86 @@
+
+from __future__ import print_function, division
+
+"""
+Scattering angles and g-vectors from lab coordinates of peaks
+
+The diffracted ray goes from the grain (origin of the sample stack,
+or a grain position in the sample frame) to the peak position on the
+detector. With k_in along the beam and k_out along the ray, both of
+length 1/wavelength:
+
+    g_lab = k_out - k_in
+    tth   = angle between k_in and k_out
+    eta   = angle around the beam, for a beam along x this is
+            atan2( -y, z ) as in ImageD11
+
+g is rotated back to the sample frame with the sample stack at the
+motor positions of each peak (e.g. omega, wedge), so any beam
+direction and any set of diffractometer axes can be used.
+"""
+
+import numpy as np
+
+
+def beam( prj ):
+    """ ( direction, wavelength ) from the Experiment.Beam of a project """
+    b = prj.stuff['Experiment']['Beam']
+    return np.asarray( b.get( 'direction', [1., 0., 0.] ), float ), \
+        float( b['wavelength'] )
+
+
+def beam_frame( direction ):
+    """
+    Unit vectors ( b, ey, ez ) with b along the beam and ez the part of
+    lab z perpendicular to it (lab y if the beam is along z)
+    """
+    b = np.asarray( direction, float )
+    b = b / np.linalg.norm( b )
+    up = np.array( [0., 0., 1.] )
+    if abs( np.dot( up, b ) ) > 0.999:
+        up = np.array( [0., 1., 0.] )
+    ez = up - np.dot( up, b ) * b
+    ez /= np.linalg.norm( ez )
+    ey = np.cross( ez, b )
+    return b, ey, ez
+
+
+def scattering( xyz, sample, wavelength, positions=None,
+                direction=( 1., 0., 0. ), origin=None ):
+    """
+    xyz : (3,N) lab positions of the peaks (e.g. from fable_detector)
+    sample : positioner or instrument for the sample stack
+    wavelength : same length units as the unit cell
+    positions : dict of name -> (N,) motor positions of each peak
+    direction : beam direction in the lab
+    origin : (3,) or (3,N) grain position in the sample frame
+    Returns tth, eta (degrees) and g (3,N) in the sample frame
+    """
+    xyz = np.asarray( xyz, float )
+    npk = xyz.shape[1]
+    if positions:
+        m4 = sample.batch_mat4( positions )
+        if len( m4 ) == 1:
+            m4 = np.repeat( m4, npk, axis=0 )
+    else:
+        m4 = np.repeat( sample.mat4()[np.newaxis], npk, axis=0 )
+    rot = m4[:, :3, :3]
+    # where each ray starts, in the lab
+    start = m4[:, :3, 3].T
+    if origin is not None:
+        o = np.asarray( origin, float )
+        if o.ndim == 1:
+            start = start + np.dot( rot, o ).T
+        else:
+            start = start + np.einsum( 'nij,jn->in', rot, o )
+    k = xyz - start
+    k /= np.sqrt( ( k * k ).sum( axis=0 ) )
+    b, ey, ez = beam_frame( direction )
+    cos_tth = np.clip( np.dot( b, k ), -1, 1 )
+    tth = np.degrees( np.arccos( cos_tth ) )
+    eta = np.degrees( np.arctan2( -np.dot( ey, k ), np.dot( ez, k ) ) )
+    # g in the lab, then back to the sample frame with R^T
+    k -= b[:, np.newaxis]
+    k /= wavelength
+    g = np.einsum( 'nji,jn->in', rot, k )
+    return tth, eta, g
@@ -0,0 +1,216 @@
+
+from __future__ import print_function, division
+
+"""
+Estimation of errors for fitted parameters
+
+- covariance from the Jacobian at the solution
+   cov = s^2 (J^T J)^-1 where s^2 = sum(r^2)/(nobs-npars)
+
+- bootstrap resampling of the peaks used in a fit
+   the peak arrays are put in shared memory which the workers
+   attach to once, then each task only carries random seeds and the
+   indices of the peaks of one grain
+"""
+
+import multiprocessing
+import numpy as np
+from . import shared
+
+
+def jacobian( func, p0, steps=None ):
+    """
+    Forward difference derivatives of func at p0
+    func(p) returns a residual vector of length M
+    returns r0 (M,) and J (M,P)
+    """
+    p0 = np.asarray( p0, float )
+    if steps is None:
+        steps = 1e-6 * np.maximum( np.abs( p0 ), 1e-3 )
+    steps = np.broadcast_to( np.asarray( steps, float ), p0.shape )
+    r0 = np.asarray( func( p0 ), float ).ravel()
+    J = np.empty( (len(r0), len(p0)), float )
+    for i in range(len(p0)):
+        p = p0.copy()
+        p[i] += steps[i]
+        J[:,i] = ( np.asarray( func( p ), float ).ravel() - r0 ) / steps[i]
+    return r0, J
+
+
+def covariance( J, residuals ):
+    """
+    Covariance matrix of the parameters from the Jacobian (M,P)
+    and the residuals (M,) at the solution.
+    Uses pinv so that badly determined parameters give large
+    errors rather than an exception.
+    """
+    J = np.asarray( J, float )
+    r = np.asarray( residuals, float ).ravel()
+    return covariance_normal( np.dot( J.T, J ), np.dot( r, r ), len( r ) )
+
+
+def covariance_normal( JtJ, chi2, nobs ):
+    """
+    Covariance from the normal matrix J^T J and the sum of squared
+    residuals, for fits that accumulate these over blocks of peaks
+    """
+    npars = len( JtJ )
+    dof = max( nobs - npars, 1 )
+    return chi2 / dof * np.linalg.pinv( JtJ )
+
+
+def uncertainties( cov ):
+    """ Standard errors (sqrt of diagonal) from a covariance matrix """
+    return np.sqrt( np.abs( np.diag( cov ) ) )
+
+
+def correlation( cov ):
+    """ Correlation matrix from a covariance matrix """
+    e = uncertainties( cov )
+    e = np.where( e > 0, e, 1 )
+    return cov / np.outer( e, e )
+
+
+# Worker process state for the bootstrap. Set once per process by
+# the pool initializer, so the peaks are not sent with every task.
+_worker = {}
+
+def _bootstrap_init( fit, spec ):
+    _worker['fit'] = fit
+    _worker['columns'] = shared.attach( spec )
+    _worker['arrays'] = [ _worker['columns'][name]
+                          for name in _worker['columns'].names ]
+
+def _resample( fit, arrays, peaks, seeds, args ):
+    """ Fits of the resamples of peaks (indices, None for all) """
+    if peaks is None:
+        peaks = np.arange( np.shape( arrays[0] )[-1] )
+    out = []
+    for seed in seeds:
+        rng = np.random.RandomState( seed )
+        idx = peaks[ rng.randint( 0, len( peaks ), len( peaks ) ) ]
+        sample = [ np.asarray(a)[..., idx] for a in arrays ]
+        out.append( np.asarray( fit( *( sample + list( args ) ) ), float ) )
+    return out
+
+
+def _bootstrap_task( task ):
+    peaks, seeds, args = task
+    return _resample( _worker['fit'], _worker['arrays'], peaks, seeds, args )
+
+
+class bootstrapper( object ):
+    """
+    A worker pool with the peak arrays attached once, for bootstrapping
+    the fits of many grains (each using a subset of the peaks)
+
+        with errors.bootstrapper( fitgrain, ( sc, fc, omega ) ) as b:
+            results = b.many( [ gm.peaks( g ) for g in gm.ids() ],
+                              args = [ ( gm[g]['ubi'], ) for g in gm.ids() ] )
+    """
+    def __init__( self, fit, arrays, processes=None ):
+        """
+        fit : function taking the resampled arrays (then any per grain
+              args) and returning the fitted parameters. Must be
+              picklable (module level) if processes != 1
+        arrays : list of peak arrays, the last axis indexes the peaks,
+              e.g. (3,N) xyz or (N,) omega, or a shared.columns holding
+              them (used in place, otherwise they are copied into one)
+        processes : size of the pool. None = cpu_count, 1 = no pool.
+        """
+        self.fit = fit
+        if isinstance( arrays, shared.columns ):
+            cols = arrays
+            arrays = [ cols[name] for name in cols.names ]
+        else:
+            cols = None
+            arrays = list( arrays )
+        self.npk = np.shape( arrays[0] )[-1]
+        for a in arrays:
+            assert np.shape( a )[-1] == self.npk, "peak arrays differ in length"
+        self.arrays = arrays
+        self.pool = None
+        self.local = None
+        if processes == 1:
+            self.processes = 1
+            return
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        if cols is None:
+            self.local = shared.columns( dict( ( "a%d"%(i), a )
+                                               for i, a in enumerate( arrays ) ) )
+            cols = self.local
+        try:
+            self.pool = multiprocessing.Pool( processes,
+                                              initializer = _bootstrap_init,
+                                              initargs = ( fit, cols.spec() ) )
+        except Exception:
+            self.close()
+            raise
+
+    def many( self, peaks, nboot=100, seed=0, args=None ):
+        """
+        Bootstrap several fits at once, the pool works on all of them
+        peaks : list of index arrays (None = all peaks), one per fit
+        args : list of tuples of extra arguments for fit, one per fit
+        Returns a list of (nboot, P) arrays
+        """
+        peaks = [ None if p is None else np.asarray( p, np.int64 )
+                  for p in peaks ]
+        if args is None:
+            args = [ () ] * len( peaks )
+        chunk = max( 1, nboot // ( 4 * self.processes ) )
+        tasks = []
+        owner = []
+        for i, ( p, a ) in enumerate( zip( peaks, args ) ):
+            for s0 in range( 0, nboot, chunk ):
+                tasks.append( ( p, list( range( seed + s0, seed + min(
+                    s0 + chunk, nboot ) ) ), tuple( a ) ) )
+                owner.append( i )
+        if self.pool is None:
+            done = [ _resample( self.fit, self.arrays, *t ) for t in tasks ]
+        else:
+            done = self.pool.map( _bootstrap_task, tasks )
+        results = [ [] for p in peaks ]
+        for i, r in zip( owner, done ):
+            results[i] += r
+        return [ np.array( r ) for r in results ]
+
+    def __call__( self, peaks=None, nboot=100, seed=0, args=() ):
+        """ (nboot, P) fitted parameters for one set of peaks """
+        return self.many( [ peaks ], nboot, seed, [ args ] )[0]
+
+    def close( self ):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.local is not None:
+            self.local.close()
+            self.local = None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+
+def bootstrap( fit, arrays, nboot=100, processes=None, seed=0 ):
+    """
+    Bootstrap resampling of peaks, see bootstrapper for the arguments.
+    Starts a pool for this one fit, use a bootstrapper to do many.
+    returns (nboot, P) array of fitted parameters
+    """
+    with bootstrapper( fit, arrays, processes ) as b:
+        return b( nboot = nboot, seed = seed )
+
+
+def bootstrap_errors( fit, arrays, nboot=100, processes=None, seed=0 ):
+    """
+    Returns the standard deviation and covariance of the parameters
+    over the bootstrap resamples
+    """
+    p = bootstrap( fit, arrays, nboot, processes, seed )
+    return p.std( axis=0, ddof=1 ), np.cov( p, rowvar=False )
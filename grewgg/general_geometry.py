@@ -1,10 +1,13 @@
 
 from __future__ import print_function, division
-import sys
+import os, sys
 import yaml
 import numpy as np
 from . import positioners
 
+# The geometry descriptions that come with grewgg
+FABLE_YML = os.path.join( os.path.dirname( __file__ ), "data", "fable.yml" )
+
 def fable_detector( pars , noisy=False ):
     """
     Takes a fable parameter dictionary and computes a static positioner
@@ -61,7 +64,7 @@ def fable_sample( pars, noisy=False ):
     Takes a fable parameter dictionary and returns a 
     diffractometer which moves vectors with omega
     """
-    d = yaml.load( open("fable.yml","r") )
+    d = yaml.safe_load( open("fable.yml","r") )
 #    print(d)
     description = d['Positioners']['Fable_diffractometer']
     p = positioners.positioner( "Fable_diffractometer" )
@@ -77,20 +80,15 @@ def fable_sample( pars, noisy=False ):
 
 def from_yml( pars, ymlfile, path,  noisy=False ):
     """
-    Takes a fable parameter dictionary and returns a 
-    diffractometer which moves vectors with omega
+    Takes a fable parameter dictionary and returns an instrument
+    built from the list of positioners found at path in the ymlfile
     """
-    description = yaml.load( open(ymlfile,"r") )
+    description = yaml.safe_load( open(ymlfile,"r") )
     for name in path:
         description = description[name]
-    p = positioners.positioner(".".join(path) ) # identity
-    pl = []
-    #  note the reverse order
-    for itemdesc in description[::-1]:
-        item = positioners.create( itemdesc, pars )
-        pl.append(item)
-        p = item*p
-        if noisy:
+    p = positioners.instrument( ".".join(path), description, pars )
+    if noisy:
+        for item in p.items:
             print(item)
     return p
 
@@ -98,8 +96,8 @@ def from_yml( pars, ymlfile, path,  noisy=False ):
         
 if __name__=="__main__":
     import sys
-    from ImageD11 import parameters
-    pars = parameters.read_par_file( sys.argv[1] ).parameters
+    from grewgg import parfile
+    pars = parfile.read_par_file( sys.argv[1] )
     print( fable_detector( pars ) )
     print( fable_sample( pars ) )
     from_yml( pars, "fable.yml", ["Positioners", "Fable_diffractometer"] )
@@ -0,0 +1,209 @@
+
+from __future__ import print_function, division
+
+"""
+Grain map results on disk, written as grains finish
+
+A folder holding:
+   grainmap.yml : version, record layout and number of peaks
+   grains.dat   : fixed size records (memory mapped), one per grain,
+                  the file grows a chunk of records at a time
+   assign.dat   : grain id for each peak (-1 = not assigned)
+   peaks.dat    : the sorted peak indices of each grain, found from the
+                  first, room and npeaks of its record
+
+Records are found by grain id through an index built when the map
+is opened. Writing a grain that is already there updates its record,
+its peak list (in place if it fits, otherwise appended to peaks.dat)
+and only the assign.dat entries of its old and new peaks. Grains that
+lose peaks to it have their lists shortened in place. Refining a
+subset of grains does not rewrite or rescan the whole map, and the
+per peak data stays on disk.
+
+    gm = grainmap.grainmap( "map", npeaks = len( omega ) )
+    gm.write( 12, ubi, translation, errors = e, peaks = indices )
+    gm.flush()
+"""
+
+import os
+import yaml
+import numpy as np
+
+VERSION = 2
+
+RECORD = np.dtype( [ ( 'id', np.int64 ),
+                     ( 'valid', np.int8 ),
+                     ( 'ubi', np.float64, (3, 3) ),
+                     ( 'translation', np.float64, (3,) ),
+                     ( 'errors', np.float64, (12,) ), # ubi then translation
+                     ( 'npeaks', np.int64 ),
+                     ( 'first', np.int64 ),   # peak list in peaks.dat
+                     ( 'room', np.int64 ),    # space there
+                     ( 'chi2', np.float64 ) ] )
+
+
+class grainmap( object ):
+    """ Chunked, memory mapped store of per grain and per peak results """
+    def __init__( self, folder, npeaks=None, chunk=1024 ):
+        """
+        folder : created if needed
+        npeaks : number of peaks, needed for a new map
+        chunk : records added each time grains.dat grows
+        """
+        self.folder = folder
+        self.chunk = chunk
+        header = os.path.join( folder, "grainmap.yml" )
+        if os.path.exists( header ):
+            h = yaml.safe_load( open( header, "r" ) )
+            if h['version'] != VERSION:
+                raise ValueError( "grainmap version %s, expected %s"%(
+                    h['version'], VERSION ) )
+            self.npeaks = h['npeaks']
+        else:
+            if npeaks is None:
+                raise ValueError( "npeaks is needed for a new grainmap" )
+            if not os.path.isdir( folder ):
+                os.makedirs( folder )
+            self.npeaks = int( npeaks )
+            a = np.memmap( self._path( "assign.dat" ), dtype=np.int64,
+                           mode="w+", shape=( max( self.npeaks, 1 ), ) )
+            a[:] = -1
+            a.flush()
+            del a
+            open( self._path( "grains.dat" ), "wb" ).close()
+            open( self._path( "peaks.dat" ), "wb" ).close()
+            with open( header, "w" ) as f:
+                f.write( yaml.dump( { 'version' : VERSION,
+                                      'npeaks' : self.npeaks,
+                                      'record' : str( RECORD.descr ) } ) )
+        self.assign = np.memmap( self._path( "assign.dat" ), dtype=np.int64,
+                                 mode="r+" )[:self.npeaks]
+        self._map_records()
+        valid = np.nonzero( self.records['valid'] )[0]
+        self.index = dict( zip( self.records['id'][valid].tolist(),
+                                valid.tolist() ) )
+        self.nrecords = int( valid.max() ) + 1 if len( valid ) else 0
+        self._lists = None
+
+    def _path( self, name ):
+        return os.path.join( self.folder, name )
+
+    def _map_records( self ):
+        n = os.path.getsize( self._path( "grains.dat" ) ) // RECORD.itemsize
+        if n == 0:
+            self.records = np.zeros( 0, RECORD )
+        else:
+            self.records = np.memmap( self._path( "grains.dat" ),
+                                      dtype=RECORD, mode="r+", shape=(n,) )
+
+    def _peak_lists( self ):
+        """ peaks.dat as a memory mapped int64 array """
+        if self._lists is None:
+            n = os.path.getsize( self._path( "peaks.dat" ) ) // 8
+            if n == 0:
+                self._lists = np.zeros( 0, np.int64 )
+            else:
+                self._lists = np.memmap( self._path( "peaks.dat" ),
+                                         dtype=np.int64, mode="r+",
+                                         shape=(n,) )
+        return self._lists
+
+    def _set_peaks( self, i, peaks ):
+        """ Store the peak list of record i, in place if there is room """
+        rec = self.records[i:i+1]
+        if len( peaks ) > rec['room'][0]:
+            if isinstance( self._lists, np.memmap ):
+                self._lists.flush()
+            with open( self._path( "peaks.dat" ), "ab" ) as f:
+                rec['first'] = f.seek( 0, 2 ) // 8
+                f.write( peaks.astype( np.int64 ).tobytes() )
+            rec['room'] = len( peaks )
+            self._lists = None
+        else:
+            first = rec['first'][0]
+            self._peak_lists()[ first : first + len( peaks ) ] = peaks
+        rec['npeaks'] = len( peaks )
+
+    def _grow( self ):
+        """ Add a chunk of empty records to the end of the file """
+        if len( self.records ):
+            self.records.flush()
+        with open( self._path( "grains.dat" ), "ab" ) as f:
+            f.write( np.zeros( self.chunk, RECORD ).tobytes() )
+        self._map_records()
+
+    def __contains__( self, gid ):
+        return gid in self.index
+
+    def __len__( self ):
+        return len( self.index )
+
+    def __getitem__( self, gid ):
+        """ The record of a grain (a view into the file) """
+        return self.records[ self.index[ gid ] ]
+
+    def ids( self ):
+        return sorted( self.index )
+
+    def write( self, gid, ubi, translation, errors=None, peaks=None,
+               chi2=0.0 ):
+        """
+        Add or update a grain
+        peaks : indices of the peaks assigned to this grain, any
+                peaks it had before are released first and peaks
+                taken from other grains are removed from them
+        """
+        if gid in self.index:
+            i = self.index[ gid ]
+            if peaks is not None:
+                self.release( gid )
+        else:
+            if self.nrecords == len( self.records ):
+                self._grow()
+            i = self.nrecords
+            self.nrecords += 1
+        rec = self.records[i:i+1]
+        rec['id'] = gid
+        rec['ubi'] = ubi
+        rec['translation'] = translation
+        rec['errors'] = 0 if errors is None else errors
+        rec['chi2'] = chi2
+        self.index[ gid ] = i
+        if peaks is not None:
+            peaks = np.unique( np.asarray( peaks, np.int64 ) )
+            before = np.asarray( self.assign[ peaks ] )
+            for other in np.unique( before[ before >= 0 ] ).tolist():
+                if other in self.index and other != gid:
+                    self._set_peaks( self.index[ other ], np.setdiff1d(
+                        self.peaks( other ), peaks, assume_unique=True ) )
+            self.assign[ peaks ] = gid
+            self._set_peaks( i, peaks )
+        rec['valid'] = 1
+
+    def release( self, gid ):
+        """ Unassign the peaks of a grain """
+        self.assign[ self.peaks( gid ) ] = -1
+        self.records['npeaks'][ self.index[ gid ] ] = 0
+
+    def peaks( self, gid ):
+        """ Indices of the peaks assigned to a grain """
+        rec = self.records[ self.index[ gid ] ]
+        first, n = int( rec['first'] ), int( rec['npeaks'] )
+        return np.array( self._peak_lists()[ first : first + n ] )
+
+    def remove( self, gid ):
+        """ Drop a grain, its record slot is left empty """
+        self.release( gid )
+        self.records['valid'][ self.index.pop( gid ) ] = 0
+
+    def table( self ):
+        """ The valid records, in grain id order, as an array """
+        order = [ self.index[ gid ] for gid in self.ids() ]
+        return np.array( self.records[ order ] )
+
+    def flush( self ):
+        if len( self.records ):
+            self.records.flush()
+        if isinstance( self._lists, np.memmap ):
+            self._lists.flush()
+        self.assign.flush()
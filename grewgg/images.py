@@ -0,0 +1,193 @@
+
+from __future__ import print_function, division
+
+"""
+Image corrections before the peak search
+
+Built from the detector block of a scan measurement in the project:
+
+    frelon21 :
+        dark : dark1s.edf
+        darkoffset : 12
+        flood : frelon21_oct16.edf
+        binning : [1, 1]
+        flips : [No, No]
+    monitor :
+        name : pico6
+        value : 1e7
+
+    corrected = ( raw - dark + darkoffset ) / flood * value / monitor
+
+The reference images are combined once into one array to subtract and
+one to multiply. Each frame (or a (B,H,W) batch of frames) is then
+done in a single pass over blocks of rows, writing into one output
+buffer, with binning and flips at the end (flips are views).
+"""
+
+import os
+import concurrent.futures
+import numpy as np
+
+
+def read_image( filename ):
+    """ Returns the data and header of an image (needs fabio) """
+    import fabio
+    im = fabio.open( filename )
+    return im.data, im.header
+
+
+def _yes( value ):
+    if isinstance( value, str ):
+        return value.lower() in ( 'yes', 'true', 'y', '1' )
+    return bool( value )
+
+
+def counter( header, name ):
+    """ A counter from a frame header, either as its own key or in the
+    counter_mne / counter_pos lists of ESRF edf headers """
+    if name in header:
+        return float( header[ name ] )
+    names = header.get( 'counter_mne', '' ).split()
+    if name in names:
+        values = header.get( 'counter_pos', '' ).split()
+        if len( values ) == len( names ):
+            return float( values[ names.index( name ) ] )
+    raise KeyError( "monitor %s not found in the frame header"%( name ) )
+
+
+class correction( object ):
+    """ Dark, flood, monitor, binning and flips for a detector """
+    def __init__( self, dark=None, darkoffset=0, flood=None,
+                  binning=(1,1), flips=(False,False), monitor=None,
+                  monitor_value=1.0, dtype=np.float32, rowblock=64 ):
+        """
+        dark, flood : reference images (or None)
+        monitor : header key for the monitor reading of each frame
+        monitor_value : what the monitor is normalised to
+        rowblock : rows done at once, so all the steps work in cache
+        """
+        self.dtype = np.dtype( dtype )
+        self.sub = None
+        if dark is not None:
+            self.sub = np.asarray( dark, self.dtype ) - self.dtype.type(
+                darkoffset )
+        elif darkoffset:
+            self.sub = self.dtype.type( -darkoffset )
+        self.mul = None
+        if flood is not None:
+            f = np.asarray( flood, self.dtype )
+            self.mul = np.where( f > 0, 1 / np.where( f > 0, f, 1 ), 0
+                                 ).astype( self.dtype )
+        self.binning = tuple( int(b) for b in binning )
+        self.flips = tuple( _yes( f ) for f in flips )
+        self.monitor = monitor
+        self.monitor_value = float( monitor_value )
+        self.rowblock = rowblock
+
+    def norm( self, header ):
+        """ Monitor normalisation for a frame header """
+        if self.monitor is None or header is None:
+            return 1.0
+        return self.monitor_value / counter( header, self.monitor )
+
+    def __call__( self, raw, norm=1.0, out=None ):
+        """
+        raw : (H,W) frame or (B,H,W) batch
+        norm : scalar or (B,) monitor normalisation
+        out : optional (..,H,W) buffer of self.dtype to reuse
+        """
+        raw = np.asarray( raw )
+        if out is None:
+            out = np.empty( raw.shape, self.dtype )
+        norm = np.asarray( norm, self.dtype )
+        if norm.ndim:
+            norm = norm.reshape( (-1,) + (1,) * ( raw.ndim - 1 ) )
+        apply_norm = norm.ndim or norm != 1
+        nrows = raw.shape[-2]
+        for r0 in range( 0, nrows, self.rowblock ):
+            s = ( Ellipsis, slice( r0, r0 + self.rowblock ), slice( None ) )
+            o = out[s]
+            if self.sub is None:
+                o[...] = raw[s]
+            else:
+                sub = self.sub if np.ndim( self.sub ) == 0 else self.sub[s]
+                np.subtract( raw[s], sub, out=o, casting='unsafe' )
+            if self.mul is not None:
+                np.multiply( o, self.mul[s], out=o )
+            if apply_norm:
+                np.multiply( o, norm, out=o )
+        if self.binning != (1,1):
+            out = self.bin( out )
+        if self.flips[0]:
+            out = out[..., ::-1, :]
+        if self.flips[1]:
+            out = out[..., :, ::-1]
+        return out
+
+    def bin( self, im ):
+        """ Sum blocks of binning pixels """
+        b0, b1 = self.binning
+        h = im.shape[-2] // b0
+        w = im.shape[-1] // b1
+        im = im[..., :h*b0, :w*b1]
+        return im.reshape( im.shape[:-2] + ( h, b0, w, b1 ) ).sum(
+            axis=( -3, -1 ) )
+
+    def read( self, filename ):
+        """ Read and correct one frame """
+        data, header = read_image( filename )
+        return self( data, self.norm( header ) )
+
+    def frames( self, filenames, nthreads=4, readahead=8 ):
+        """
+        Generator of corrected frames in order. Files are read and
+        corrected on a thread pool up to readahead frames in advance,
+        so the decompression overlaps with the corrections.
+        """
+        filenames = list( filenames )
+        with concurrent.futures.ThreadPoolExecutor( nthreads ) as pool:
+            jobs = [ pool.submit( self.read, f )
+                     for f in filenames[:readahead] ]
+            for i in range( len( filenames ) ):
+                if i + readahead < len( filenames ):
+                    jobs.append( pool.submit( self.read,
+                                              filenames[i + readahead] ) )
+                yield jobs[i].result()
+                jobs[i] = None
+
+
+def from_yml( measurement, monitor=None, folder=None ):
+    """
+    Corrections from the measurement block of a detector and the
+    (optional) monitor block. Relative reference image names are
+    taken from folder (default the image folder).
+    """
+    if folder is None:
+        images = measurement.get( 'images', {} )
+        if isinstance( images, dict ):
+            folder = images.get( 'folder', '' )
+        else:
+            folder = measurement.get( 'ImageFolder', '' )
+    def ref( key ):
+        if measurement.get( key ) is None:
+            return None
+        return read_image( os.path.join( folder, measurement[key] ) )[0]
+    kwds = {}
+    if monitor is not None:
+        kwds[ 'monitor' ] = monitor[ 'name' ]
+        kwds[ 'monitor_value' ] = float( monitor.get( 'value', 1.0 ) )
+    return correction( dark = ref( 'dark' ),
+                       darkoffset = measurement.get( 'darkoffset', 0 ),
+                       flood = ref( 'flood' ),
+                       binning = measurement.get( 'binning', (1,1) ),
+                       flips = measurement.get( 'flips', (False,False) ),
+                       **kwds )
+
+
+def from_project( prj, scan, detector ):
+    """ Corrections for a detector in a scan of a project """
+    try:
+        monitor = prj.measurement( scan, 'monitor' )
+    except KeyError:
+        monitor = None
+    return from_yml( prj.measurement( scan, detector ), monitor )
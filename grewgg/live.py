@@ -0,0 +1,131 @@
+
+from __future__ import print_function, division
+
+"""
+Live processing of a scan while it is being collected
+
+Watches for the image files of a scan to appear (polling, so it
+works on network filesystems), corrects each new frame and runs the
+peak search on a worker pool, then appends the peaks to the project
+peak store in frame order. The background is not subtracted, so the
+peaks go to a separate _live.flt next to the one of the Peaks stage.
+
+- backpressure : at most maxinflight frames are queued or running,
+  the watcher stops looking ahead until the writer catches up
+- resume : the peak store records the next frame, a restart skips
+  the finished frames
+
+    python -m grewgg.live project.yml scan_2 frelon21
+"""
+
+import os, time, asyncio
+import concurrent.futures
+from . import peaksearch, projects, images
+
+
+# Image corrections for the frames, set once per worker process
+_worker = {}
+
+def set_correction( corr ):
+    """ Pool initializer, the reference images go once to each worker """
+    _worker['correction'] = corr
+
+
+def process_frame( filename, omega, threshold ):
+    """ Worker: read one frame, correct it and search it for peaks """
+    data, header = images.read_image( filename )
+    corr = _worker.get( 'correction' )
+    if corr is not None:
+        data = corr( data, corr.norm( header ) )
+    return peaksearch.frame_peaks( data, threshold, omega )
+
+
+async def _arrived( filename, poll, timeout ):
+    """ Wait until a file exists and has stopped growing """
+    t0 = time.time()
+    size = -1
+    while True:
+        if os.path.exists( filename ):
+            now = os.path.getsize( filename )
+            if now == size and now > 0:
+                return True
+            size = now
+        if timeout is not None and time.time() - t0 > timeout:
+            return False
+        await asyncio.sleep( poll )
+
+
+async def watch( frames, process, store, executor=None, maxinflight=8,
+                 poll=0.5, timeout=None, args=() ):
+    """
+    frames : list of ( index, filename, omega ) in collection order
+    process : process( filename, omega, *args ) -> dict of peak columns,
+              must be picklable for a process pool
+    store : projects.peakstore (or anything with .done and .append)
+    executor : concurrent.futures pool, None for the loop default
+    timeout : give up if a frame does not arrive (scan aborted)
+    Returns the number of frames processed
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue( maxsize = maxinflight )
+    todo = [ f for f in frames if f[0] >= store.done ]
+
+    async def producer():
+        try:
+            for index, filename, omega in todo:
+                if not await _arrived( filename, poll, timeout ):
+                    break
+                job = loop.run_in_executor( executor, process, filename,
+                                            omega, *args )
+                await queue.put( ( index, job ) )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # let the writer finish the queued frames, then re-raise
+            await queue.put( None )
+            raise
+        await queue.put( None )
+
+    async def writer():
+        n = 0
+        while True:
+            item = await queue.get()
+            if item is None:
+                return n
+            index, job = item
+            store.append( index, await job )
+            n += 1
+
+    task = asyncio.ensure_future( producer() )
+    try:
+        n = await writer()
+        await task # raises if the producer failed
+    finally:
+        task.cancel()
+    return n
+
+
+def run( prj, scan, detector, processes=None, correct=True, restart=False,
+         **kwds ):
+    """ Live peak search for a scan of a project, at the lowest threshold
+    correct : apply the dark/flood/monitor/... corrections of the scan
+    restart : start again, replacing any existing peak file """
+    if not isinstance( prj, projects.project ):
+        prj = projects.project( prj )
+    threshold = min( prj.processing( scan, detector )['Peaks']['thresholds'] )
+    store = prj.peakstore( scan, detector, restart = restart,
+                           background = False )
+    corr = None
+    if correct:
+        corr = images.from_project( prj, scan, detector )
+    with concurrent.futures.ProcessPoolExecutor(
+            processes, initializer = set_correction,
+            initargs = ( corr, ) ) as pool:
+        return asyncio.run( watch( prj.frames( scan, detector ),
+                                   process_frame, store, executor=pool,
+                                   args=( threshold, ), **kwds ) )
+
+
+if __name__ == "__main__":
+    import sys
+    print( run( sys.argv[1], sys.argv[2], sys.argv[3] ), "frames" )
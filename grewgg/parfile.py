@@ -0,0 +1,67 @@
+
+from __future__ import print_function, division
+
+"""
+Fable / ImageD11 .par files without ImageD11
+
+A .par file has one "name value" pair per line. Numbers are converted
+to float once when reading, anything else (e.g. the lattice letter)
+stays a string. Many files can be read into one table of arrays, one
+entry per file, ready for instrument.batch_mat4:
+
+    table = parfile.read_par_files( filenames,
+                                    names = detector.parameters() )
+    xyz = detector.batch( v, table )       # (K,3,N)
+"""
+
+import numpy as np
+
+
+def _value( text ):
+    try:
+        return float( text )
+    except ValueError:
+        return text
+
+
+def read_par_file( filename ):
+    """ dict of name -> float (or str) """
+    pars = {}
+    with open( filename, "r" ) as f:
+        for line in f:
+            words = line.split( None, 1 )
+            if len( words ) < 2 or words[0].startswith( "#" ):
+                continue
+            pars[ words[0] ] = _value( words[1].strip() )
+    return pars
+
+
+def write_par_file( filename, pars ):
+    """ Writes a dict as a .par file, sorted by name """
+    with open( filename, "w" ) as f:
+        for name in sorted( pars ):
+            f.write( "%s %s\n"%( name, repr( pars[name] )
+                                 if isinstance( pars[name], float )
+                                 else str( pars[name] ) ) )
+
+
+def read_par_files( filenames, names=None ):
+    """
+    Reads many .par files into a dict of name -> (K,) float arrays
+    names : the parameters wanted (default all numeric ones found in
+            every file). A missing or non numeric value is an error.
+    """
+    filenames = list( filenames )
+    sets = [ read_par_file( f ) for f in filenames ]
+    if names is None:
+        names = [ k for k in sets[0] if all(
+            [ isinstance( s.get( k ), float ) for s in sets ] ) ] if sets else []
+    table = {}
+    for name in names:
+        col = np.empty( len( sets ) )
+        for i, s in enumerate( sets ):
+            if not isinstance( s.get( name ), float ):
+                raise ValueError( "%s has no numeric %s"%( filenames[i], name ) )
+            col[i] = s[name]
+        table[ name ] = col
+    return table
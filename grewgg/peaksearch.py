@@ -0,0 +1,86 @@
+
+from __future__ import print_function, division
+
+"""
+Peak search by connected pixels above a threshold
+
+Pixels are given as sorted integer keys, so the same labelling works
+for a single frame (key = row*W + col) or for a stack of frames
+with connections in omega (key = frame*H*W + row*W + col). The rows
+are padded by one (W = ncols + 1) so that neighbours do not wrap.
+
+Columns follow the .flt names. No spatial distortion is applied here
+so sc, fc are the raw slow/fast centroids.
+"""
+
+import numpy as np
+
+FLT_COLUMNS = [ 'sc', 'fc', 'omega', 'Number_of_pixels', 'sum_intensity' ]
+
+
+def neighbours_2d( ncols ):
+    """ Positive key offsets of the 8 connected neighbours in a frame """
+    W = ncols + 1
+    return [ 1, W - 1, W, W + 1 ]
+
+
+def label_keys( keys, offsets ):
+    """
+    Connected components of pixels given as sorted integer keys.
+    Two pixels touch if their keys differ by one of the offsets.
+    Returns labels (0..n-1 for each pixel) and n
+    """
+    keys = np.asarray( keys )
+    n = len( keys )
+    if n == 0:
+        return np.zeros( 0, int ), 0
+    a = []
+    b = []
+    for off in offsets:
+        target = keys + off
+        j = np.minimum( np.searchsorted( keys, target ), n - 1 )
+        hit = keys[j] == target
+        a.append( np.nonzero( hit )[0] )
+        b.append( j[hit] )
+    a = np.concatenate( a )
+    b = np.concatenate( b )
+    # min label propagation with pointer jumping
+    labels = np.arange( n )
+    while True:
+        m = np.minimum( labels[a], labels[b] )
+        new = labels.copy()
+        np.minimum.at( new, a, m )
+        np.minimum.at( new, b, m )
+        new = new[ new ]
+        if ( new == labels ).all():
+            break
+        labels = new
+    roots, labels = np.unique( labels, return_inverse=True )
+    return labels, len( roots )
+
+
+def moments( labels, n, rows, cols, values, omega ):
+    """ Intensity weighted centroids of labelled pixels as .flt columns """
+    values = np.asarray( values, float )
+    npx = np.bincount( labels, minlength=n )
+    sI = np.bincount( labels, values, minlength=n )
+    w = np.where( sI != 0, sI, 1 )
+    return {
+        'sc' : np.bincount( labels, values * rows, minlength=n ) / w,
+        'fc' : np.bincount( labels, values * cols, minlength=n ) / w,
+        'omega' : np.bincount( labels, values * omega, minlength=n ) / w,
+        'Number_of_pixels' : npx,
+        'sum_intensity' : sI,
+        }
+
+
+def frame_peaks( image, threshold, omega=0.0 ):
+    """ Peaks in a single 2D frame (rows = slow, cols = fast) """
+    image = np.asarray( image )
+    rows, cols = np.nonzero( image > threshold )
+    values = image[ rows, cols ]
+    keys = rows * ( image.shape[1] + 1 ) + cols
+    labels, n = label_keys( keys, neighbours_2d( image.shape[1] ) )
+    return moments( labels, n, rows, cols, values,
+                    np.full( len(rows), omega, float ) )
+
@@ -2,6 +2,8 @@
 # for python2/python3
 from __future__ import print_function
 
+import json, struct
+import concurrent.futures
 import numpy as np
 
 
@@ -24,8 +26,9 @@ class positioner( object ):
     def __call__(self, v):
         """ If v is a vec[3][N] we compute m4.v """
         va = np.asarray( v ) 
-        rot = np.dot( self.m4[:3,:3], va )
-        t   = self.m4[:3,3]
+        m4 = self.mat4()
+        rot = np.dot( m4[:3,:3], va )
+        t   = m4[:3,3]
         return rot + t[:,np.newaxis]
     def __mul__(self, other):
         """ Chain together two positioner operations via their mat4 """
@@ -58,6 +61,14 @@ class translation( positioner ):
         m4[:3,3] = self.axis * self.position
         return m4
     
+    def mat4s(self, positions):
+        """ (K,4,4) matrices for an array of K positions """
+        p = np.asarray( positions, float )
+        m4 = np.zeros( (len(p), 4, 4) )
+        m4[:] = np.eye(4)
+        m4[:,:3,3] = p[:,np.newaxis] * self.axis
+        return m4
+    
     def __call__(self, v, position = None):
         """
         v is (3, N) vector
@@ -96,6 +107,7 @@ class scale( positioner ):
         self.name = name
         v = np.asarray( axis ).astype( int )
         assert v.sum()==1 and (v>0).sum() == 1, "scale type is for x or y or z"
+        self.axis = v
         self.position = position
         self.scalevec = float(position)*v + (1-v)        
         
@@ -105,6 +117,15 @@ class scale( positioner ):
         m4[1,1] = self.scalevec[1]
         m4[2,2] = self.scalevec[2]
         return m4
+
+    def mat4s(self, positions):
+        """ (K,4,4) matrices for an array of K positions """
+        p = np.asarray( positions, float )
+        m4 = np.zeros( (len(p), 4, 4) )
+        m4[:] = np.eye(4)
+        for i in range(3):
+            m4[:,i,i] = p * self.axis[i] + (1 - self.axis[i])
+        return m4
     
     def __call__(self, v, position = None):
         """
@@ -155,6 +176,21 @@ class rotation( positioner ):
         m4[:3,:3] = self.make_matrix( self.position )
         return m4
     
+    def mat4s(self, positions):
+        """ (K,4,4) matrices for an array of K angles in degrees
+        Rodrigues formula: cos.I + sin.[a]x + (1-cos).a.aT """
+        p = np.radians( np.asarray( positions, float ) )
+        c = np.cos( p )[:, np.newaxis, np.newaxis]
+        s = np.sin( p )[:, np.newaxis, np.newaxis]
+        a = self.axis
+        ax = np.array( [[    0, -a[2],  a[1] ],
+                        [ a[2],     0, -a[0] ],
+                        [-a[1],  a[0],     0 ]] )
+        m4 = np.zeros( (len(p), 4, 4) )
+        m4[:,3,3] = 1
+        m4[:,:3,:3] = c * np.eye(3) + s * ax + (1 - c) * np.outer( a, a )
+        return m4
+    
     def axis_angle( self, v, position = None):
         """ Use when position may be different for each x 
         a = axis
@@ -219,9 +255,29 @@ class rotation( positioner ):
 
 def interpret( symbol, pars ):
     if symbol in pars:
-        return float(pars[symbol])
+        value = pars[symbol]
     else:
-        return float(symbol)
+        value = symbol
+    if type( value ) is float: # already converted, e.g. by parfile
+        return value
+    if np.ndim( value ):
+        return np.asarray( value, float )
+    return float( value )
+
+
+def position( ymld, pars ):
+    """ Position of a rotation/translation/scale in the units used by
+    the positioner (tilts are given in radians in fable pars).
+    Works for scalars or arrays of positions in pars """
+    name = ymld['name']
+    pos = 0
+    if 'pos' in ymld:
+        pos = ymld['pos']
+    if name in pars:
+        pos = pars[name]
+    if ymld['type'] == "rotation" and name.find("tilt") == 0:
+        pos = np.degrees( pos )
+    return pos
 
     
 def create( ymld, pars ):
@@ -230,19 +286,13 @@ def create( ymld, pars ):
     typ   = ymld['type']
 
     if typ in ['rotation','translation','scale']:
-        pos   = 0
         axis  = ymld[ 'axis' ]
-        if pos in ymld:
-            pos = ymld['pos']
-        if name in pars:
-            pos = pars[name]
+        pos   = position( ymld, pars )
             
         if ymld['type'] == "translation":
             return translation( name, axis, pos )
         
         if ymld['type'] == "rotation":
-            if name.find("tilt") == 0:
-                pos = np.degrees( pos )
             return rotation( name, axis, pos )
 
         if ymld['type'] == "scale":
@@ -254,10 +304,464 @@ def create( ymld, pars ):
         return positioner( name, np.array(m4) )
                 
     raise Exception("Cannot figure out"+str(ymld))
+
+
+def create_batch( ymld, pars, npos ):
+    """ As create, but pars may hold arrays of npos positions.
+    Returns the (npos,4,4) stack of matrices """
+    typ = ymld['type']
+    if typ in ['rotation','translation','scale']:
+        item = create( ymld, {} ) # for the axis
+        pos = np.broadcast_to( np.asarray( position( ymld, pars ), float ),
+                               (npos,) )
+        return item.mat4s( pos )
+    if typ == "positioner":
+        m4 = np.empty( (npos, 4, 4) )
+        for i, row in enumerate( ymld['mat4'] ):
+            for j, symbol in enumerate( row ):
+                m4[:,i,j] = interpret( symbol, pars )
+        return m4
+    raise Exception("Cannot figure out"+str(ymld))
     
     
 
-class instrument( object ):
-    """ Represents an instrument as a stack of positioners """
-    def __init__(self, name, positioners):
-        pass
+def symbols( ymld ):
+    """ The parameter names that a yml positioner description depends on """
+    if ymld['type'] == "positioner":
+        return [ symbol for row in ymld['mat4'] for symbol in row
+                 if isinstance( symbol, str ) ]
+    return [ ymld['name'] ]
+
+
+class instrument( positioner ):
+    """ Represents an instrument as a stack of positioners
+
+    Built from a list of yml descriptions (as in fable.yml, the last
+    one is applied first to the vectors) and a parameter dictionary.
+
+    The products of the positioners before and after each one are
+    cached, so that when a single parameter is changed (e.g. during
+    a fit) the total matrix costs one matrix build and two multiplies.
+    Vectors are only transformed when the instrument is called.
+    """
+    def __init__(self, name, positioners, pars=None):
+        self.name = name
+        # in the order they are applied to vectors
+        self.descriptions = list( positioners )[::-1]
+        self.pars = dict( pars or {} )
+        self.items = [ create( d, self.pars ) for d in self.descriptions ]
+        self.mats = [ item.mat4() for item in self.items ]
+        # which items to rebuild when a parameter changes
+        self.depends = {}
+        for i, d in enumerate( self.descriptions ):
+            for s in symbols( d ):
+                self.depends.setdefault( s, [] ).append( i )
+        n = len( self.items )
+        self._before = [ None ] * n  # mats[i-1] ... mats[0]
+        self._after  = [ None ] * n  # mats[n-1] ... mats[i+1]
+        self._m4 = None
+        self._last = 0
+
+    def parameters( self ):
+        """ Names of the parameters which can be changed """
+        return list( self.depends.keys() )
+
+    def get( self, name ):
+        """ Current value of a parameter, the yml pos if it was not set """
+        if name in self.pars:
+            return self.pars[ name ]
+        for d in self.descriptions:
+            if d['name'] == name and d['type'] in AXIS_TYPES:
+                return d.get( 'pos', 0 )
+        raise KeyError( "%s is not a parameter of %s"%( name, self.name ) )
+
+    def set( self, name, value ):
+        """ Change a parameter and mark the items using it as dirty """
+        if name not in self.depends:
+            raise KeyError( "%s is not a parameter of %s"%( name, self.name ) )
+        self.pars[ name ] = value
+        n = len( self.items )
+        for i in self.depends[ name ]:
+            self.items[i] = create( self.descriptions[i], self.pars )
+            self.mats[i] = self.items[i].mat4()
+            for j in range( i+1, n ):
+                self._before[j] = None
+            for j in range( i ):
+                self._after[j] = None
+            self._last = i
+        self._m4 = None
+
+    def update( self, pars ):
+        """ Change several parameters """
+        for name in pars:
+            self.set( name, pars[name] )
+
+    def before( self, i ):
+        """ Product of the items applied before item i """
+        j = i
+        while j > 0 and self._before[j] is None:
+            j -= 1
+        if self._before[j] is None:
+            self._before[j] = np.eye(4)
+        while j < i:
+            self._before[j+1] = np.dot( self.mats[j], self._before[j] )
+            j += 1
+        return self._before[i]
+
+    def after( self, i ):
+        """ Product of the items applied after item i """
+        n = len( self.items )
+        j = i
+        while j < n-1 and self._after[j] is None:
+            j += 1
+        if self._after[j] is None:
+            self._after[j] = np.eye(4)
+        while j > i:
+            self._after[j-1] = np.dot( self._after[j], self.mats[j] )
+            j -= 1
+        return self._after[i]
+
+    def batch_mat4( self, pars ):
+        """
+        Matrices for K parameter sets at once
+        pars : dict of name -> (K,) array (or scalar), the other
+               parameters keep their current values
+        returns (K,4,4)
+        """
+        for name in pars:
+            if name not in self.depends:
+                raise KeyError( "%s is not a parameter of %s"%(
+                    name, self.name ) )
+        npos = max( [ np.size( pars[name] ) for name in pars ] + [1] )
+        merged = dict( self.pars )
+        merged.update( pars )
+        stack = None
+        const = np.eye(4) # run of unchanged items, folded together
+        for i, d in enumerate( self.descriptions ):
+            if any( [ s in pars for s in symbols( d ) ] ):
+                m = np.matmul( create_batch( d, merged, npos ), const )
+                if stack is None:
+                    stack = m
+                else:
+                    stack = np.matmul( m, stack )
+                const = np.eye(4)
+            else:
+                const = np.dot( self.mats[i], const )
+        if stack is None:
+            return np.repeat( const[np.newaxis], npos, axis=0 )
+        return np.matmul( const, stack )
+
+    def __call__( self, v, positions=None ):
+        """
+        v is (3, N) vectors
+        positions : dict of name -> (N,) motor positions, one per
+                    vector (e.g. omega of each peak), or None
+        """
+        if positions is None:
+            return positioner.__call__( self, v )
+        m4 = self.batch_mat4( positions )
+        out = np.einsum( 'nij,jn->in', m4[:,:3,:3], np.asarray( v, float ) )
+        out += m4[:,:3,3].T
+        return out
+
+    def batch( self, v, pars, observed=None ):
+        """
+        Apply K parameter sets to the (3,N) vectors v
+        returns (K,3,N) coordinates, or residuals if observed is given
+        """
+        m4 = self.batch_mat4( pars )
+        out = np.matmul( m4[:,:3,:3], np.asarray( v, float ) )
+        out += m4[:,:3,3,np.newaxis]
+        if observed is not None:
+            out -= observed
+        return out
+
+    def compile( self, moving=() ):
+        """
+        Fold everything except the moving axes into constant matrices
+        moving : names of rotation/translation/scale items to keep free
+        """
+        names = [ d['name'] for d in self.descriptions ]
+        for name in moving:
+            if name not in names:
+                raise KeyError( "%s is not an axis of %s"%( name, self.name ) )
+        consts = []
+        axes = []
+        const = np.eye(4)
+        for d, m in zip( self.descriptions, self.mats ):
+            if d['name'] in moving:
+                if d['type'] not in AXIS_TYPES:
+                    raise ValueError( "Cannot move a %s"%( d['type'] ) )
+                consts.append( const )
+                axes.append( ( d['name'], d['type'], create( d, {} ).axis,
+                               float( self.pars.get( d['name'],
+                                                     d.get( 'pos', 0 ) ) ) ) )
+                const = np.eye(4)
+            else:
+                const = np.dot( m, const )
+        consts.append( const )
+        return compiled( self.name, consts, axes, self.pars )
+
+    def save( self, filename, moving=() ):
+        """ Save the compiled instrument, see load """
+        self.compile( moving ).save( filename )
+
+    def mat4( self ):
+        """ Total matrix, only the dirty parts are recomputed """
+        if self._m4 is None:
+            if len( self.items ) == 0:
+                self._m4 = np.eye(4)
+            else:
+                k = self._last
+                self._m4 = np.dot( self.after( k ),
+                                   np.dot( self.mats[k], self.before( k ) ) )
+        return self._m4
+
+    def __str__( self ):
+        return "%s:%s\n%s"%( str(type(self)), self.name,
+                             "\n".join( [ str(item) for item in self.items ] ) )
+
+
+AXIS_TYPES = [ 'translation', 'rotation', 'scale' ]
+AXIS_CLASSES = { 'translation' : translation, 'rotation' : rotation,
+                 'scale' : scale }
+
+COMPILED_MAGIC = b"GREWGG\x00\x01"
+COMPILED_VERSION = 1
+
+
+class compiled( positioner ):
+    """
+    An instrument with the fixed parts folded into constant matrices:
+        const[n] . axis[n-1] . ... . const[1] . axis[0] . const[0]
+    Only the moving axes can be set. Has the methods of the instrument
+    it came from (mat4, get, set, update, parameters, call with
+    positions, batch_mat4, batch, compile, save, items) and can be
+    saved to a small binary file which loads without yml or
+    positioners.create
+    """
+    def __init__( self, name, consts, axes, pars ):
+        """
+        consts : list of len(axes)+1 (4,4) matrices
+        axes : list of ( name, type, axis, position ) with the position
+               in pars units (radians for tilts)
+        pars : parameter values (the symbol table)
+        """
+        self.name = name
+        self.consts = np.asarray( consts, float ).reshape( -1, 4, 4 )
+        assert len( self.consts ) == len( axes ) + 1
+        self.axes = [ ( n, t, np.asarray( a, float ), float( p ) )
+                      for n, t, a, p in axes ]
+        self.pars = dict( pars )
+        self.slots = dict( ( a[0], i ) for i, a in enumerate( self.axes ) )
+        self.depends = dict( ( a[0], [i] ) for i, a in enumerate( self.axes ) )
+        self._items = [ AXIS_CLASSES[t]( n, a, 0 ) for n, t, a, p in self.axes ]
+        self._m4 = None
+
+    def _units( self, i, positions ):
+        """ pars units to the units of the axis (tilts are radians) """
+        n, t, a, p = self.axes[i]
+        if t == "rotation" and n.find( "tilt" ) == 0:
+            return np.degrees( positions )
+        return positions
+
+    def parameters( self ):
+        return [ a[0] for a in self.axes ]
+
+    def get( self, name ):
+        if name in self.slots:
+            return self.axes[ self.slots[ name ] ][3]
+        return self.pars[ name ]
+
+    def set( self, name, value ):
+        if name not in self.slots:
+            raise KeyError( "%s is not a moving axis of %s"%( name, self.name ) )
+        i = self.slots[ name ]
+        n, t, a, p = self.axes[i]
+        self.axes[i] = ( n, t, a, float( value ) )
+        self.pars[ name ] = value
+        self._m4 = None
+
+    def update( self, pars ):
+        """ Change several moving axes """
+        for name in pars:
+            self.set( name, pars[name] )
+
+    def mat4( self ):
+        if self._m4 is None:
+            self._m4 = self.batch_mat4( {} )[0]
+        return self._m4
+
+    def _axis_mat4( self, i ):
+        n, t, a, p = self.axes[i]
+        return self._items[i].mat4s( self._units( i, [ p ] ) )[0]
+
+    @property
+    def items( self ):
+        """ Positioners in the order they are applied: the constant
+        parts and the moving axes at their current positions """
+        out = [ positioner( "%s.const0"%( self.name ), self.consts[0] ) ]
+        for i, ( n, t, a, p ) in enumerate( self.axes ):
+            out.append( AXIS_CLASSES[t]( n, a, float( self._units( i, p ) ) ) )
+            out.append( positioner( "%s.const%d"%( self.name, i+1 ),
+                                    self.consts[i+1] ) )
+        return out
+
+    def batch_mat4( self, pars ):
+        """ (K,4,4) matrices for dict of name -> (K,) positions """
+        for name in pars:
+            if name not in self.slots:
+                raise KeyError( "%s is not a moving axis of %s"%(
+                    name, self.name ) )
+        npos = max( [ np.size( pars[name] ) for name in pars ] + [1] )
+        m = self.consts[0][np.newaxis]
+        for i, ( n, t, a, p ) in enumerate( self.axes ):
+            pos = np.broadcast_to( np.asarray( pars.get( n, p ), float ),
+                                   (npos,) )
+            m = np.matmul( self._items[i].mat4s( self._units( i, pos ) ), m )
+            m = np.matmul( self.consts[i+1], m )
+        if len( m ) != npos:
+            m = np.repeat( m, npos, axis=0 )
+        return m
+
+    def __call__( self, v, positions=None ):
+        """
+        v is (3, N) vectors
+        positions : dict of name -> (N,) motor positions, one per
+                    vector (e.g. omega of each peak), or None
+        """
+        if positions is None:
+            return positioner.__call__( self, v )
+        m4 = self.batch_mat4( positions )
+        out = np.einsum( 'nij,jn->in', m4[:,:3,:3], np.asarray( v, float ) )
+        out += m4[:,:3,3].T
+        return out
+
+    def batch( self, v, pars, observed=None ):
+        """
+        Apply K parameter sets to the (3,N) vectors v
+        returns (K,3,N) coordinates, or residuals if observed is given
+        """
+        m4 = self.batch_mat4( pars )
+        out = np.matmul( m4[:,:3,:3], np.asarray( v, float ) )
+        out += m4[:,:3,3,np.newaxis]
+        if observed is not None:
+            out -= observed
+        return out
+
+    def compile( self, moving=() ):
+        """ Fold the moving axes which are not in moving as well """
+        for name in moving:
+            if name not in self.slots:
+                raise KeyError( "%s is not a moving axis of %s"%(
+                    name, self.name ) )
+        consts = []
+        axes = []
+        const = self.consts[0]
+        for i, axis in enumerate( self.axes ):
+            if axis[0] in moving:
+                consts.append( const )
+                axes.append( axis )
+                const = self.consts[i+1]
+            else:
+                const = np.dot( self.consts[i+1],
+                                np.dot( self._axis_mat4( i ), const ) )
+        consts.append( const )
+        return compiled( self.name, consts, axes, self.pars )
+
+    def __str__( self ):
+        return "%s:%s\n%s"%( str(type(self)), self.name, str( self.mat4() ) )
+
+    def save( self, filename, moving=None ):
+        """
+        Binary file: magic, version, length of a json header (names,
+        types, parameter names), then float64 data: the constant
+        matrices, the axis directions and positions and the parameters
+        moving : fold the other axes first (see compile)
+        """
+        if moving is not None:
+            return self.compile( moving ).save( filename )
+        pnames = [ k for k in sorted( self.pars )
+                   if np.ndim( self.pars[k] ) == 0 and
+                   isinstance( self.pars[k], ( int, float, np.number ) ) ]
+        header = json.dumps( { 'name' : self.name,
+                               'axes' : [ [ a[0], a[1] ] for a in self.axes ],
+                               'pars' : pnames } ).encode()
+        data = np.concatenate( [
+            self.consts.ravel(),
+            np.array( [ a[2] for a in self.axes ] ).ravel(),
+            np.array( [ a[3] for a in self.axes ] ),
+            np.array( [ self.pars[k] for k in pnames ], float ) ] )
+        with open( filename, "wb" ) as f:
+            f.write( COMPILED_MAGIC )
+            f.write( struct.pack( "<II", COMPILED_VERSION, len( header ) ) )
+            f.write( header )
+            f.write( data.astype( "<f8" ).tobytes() )
+
+
+def load( filename ):
+    """ Load a compiled instrument saved by compiled.save """
+    with open( filename, "rb" ) as f:
+        raw = f.read()
+    n = len( COMPILED_MAGIC )
+    if raw[:n] != COMPILED_MAGIC:
+        raise ValueError( "%s is not a compiled geometry"%( filename ) )
+    version, hlen = struct.unpack( "<II", raw[n:n+8] )
+    if version != COMPILED_VERSION:
+        raise ValueError( "compiled geometry version %d, expected %d"%(
+            version, COMPILED_VERSION ) )
+    header = json.loads( raw[n+8:n+8+hlen].decode() )
+    data = np.frombuffer( raw, "<f8", offset = n+8+hlen )
+    naxes = len( header['axes'] )
+    i = 16 * ( naxes + 1 )
+    consts = data[:i].reshape( naxes + 1, 4, 4 )
+    dirs = data[i:i+3*naxes].reshape( naxes, 3 )
+    i += 3 * naxes
+    pos = data[i:i+naxes]
+    pars = dict( zip( header['pars'], data[i+naxes:].tolist() ) )
+    axes = [ ( a[0], a[1], d, p ) for a, d, p in zip( header['axes'], dirs,
+                                                        pos.tolist() ) ]
+    return compiled( header['name'], consts, axes, pars )
+
+
+def blocked( p, v, positions=None, out=None, blocksize=8192, nthreads=None ):
+    """
+    Apply a positioner or instrument to (3,N) vectors in tiles
+    Each tile (3 x blocksize) goes through the whole transformation
+    while it is in cache and the tiles are shared over a thread pool
+    (numpy releases the GIL), so big arrays scale with the cores
+    rather than with memory bandwidth.
+    positions : dict of per vector positions for instrument.__call__
+    out : (3,N) array for the result, may be v to work in place
+    """
+    va = np.asarray( v, float )
+    npk = va.shape[1]
+    if out is None:
+        out = np.empty( va.shape )
+    if positions is None:
+        m4 = p.mat4()
+        rot = m4[:3,:3]
+        t = m4[:3,3:]
+        def work( i0 ):
+            s = slice( i0, i0 + blocksize )
+            tile = np.dot( rot, va[:, s] )
+            tile += t
+            out[:, s] = tile
+    else:
+        positions = dict( ( name, np.asarray( positions[name], float ) )
+                          for name in positions )
+        def work( i0 ):
+            s = slice( i0, i0 + blocksize )
+            pos = {}
+            for name in positions:
+                pos[name] = positions[name][s] if positions[name].ndim \
+                    else positions[name]
+            out[:, s] = p( va[:, s], pos )
+    starts = range( 0, npk, blocksize )
+    if nthreads == 1 or npk <= blocksize:
+        for i0 in starts:
+            work( i0 )
+    else:
+        with concurrent.futures.ThreadPoolExecutor( nthreads ) as pool:
+            list( pool.map( work, starts ) )
+    return out
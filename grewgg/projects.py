@@ -22,13 +22,25 @@ Project files for ImageD11 (fable ?)
 
 - assignment of grains to peaks
 
+- processing: a scheduler runs the stages for each scan/detector
+   Background -> Peaks -> Geometry, then Refinement per scan
+
 """
 
+import os, time, traceback
+import concurrent.futures
 import yaml
+import numpy as np
+from . import peaksearch, images
+from .images import _yes
 
 class project( object ):
     def __init__(self, filename ):
-        self.stuff = yaml.load( open(filename,"r") )
+        """ filename of the yml, or the already loaded dict """
+        if isinstance( filename, dict ):
+            self.stuff = filename
+        else:
+            self.stuff = yaml.safe_load( open(filename,"r") )
     def save( self, filename ):
         open(filename,"w").write( yaml.dump( self.stuff ) )
     def __repr__(self):
@@ -36,6 +48,340 @@ class project( object ):
     def __str__(self):
         return yaml.dump( self.stuff )
 
+    def scan( self, name ):
+        """ The motor description of a scan: Motor, Step, Start, ... """
+        motor = {}
+        for item in self.stuff['Experiment']['Scans'][name]:
+            if 'measurement' not in item:
+                motor.update( item )
+        return motor
+
+    def measurement( self, name, detector ):
+        """ The measurement block of a detector (or monitor) in a scan """
+        for item in self.stuff['Experiment']['Scans'][name]:
+            for m in item.get( 'measurement', [] ):
+                if detector in m:
+                    return m[detector]
+        raise KeyError( "No %s in scan %s"%( detector, name ) )
+
+    def processing( self, name, detector ):
+        """ The processing options for a detector in a scan """
+        return self.stuff['Experiment']['processing'][name][detector]
+
+    def frames( self, name, detector ):
+        """
+        List of ( index, filename, motor position ) for a scan, in the
+        order the frames are collected.
+        Interlaced scans collect all of pass 0, then all of pass 1 which
+        is offset by half a step. With iflip pass 1 runs backwards, so
+        its first file is at the end of the scan.
+        """
+        motor = self.scan( name )
+        start = float( motor.get( 'Start', 0 ) )
+        step = float( motor.get( 'Step', 0 ) )
+        images = self.measurement( name, detector )['images']
+        if isinstance( images, list ):
+            folder = self.measurement( name, detector ).get( 'ImageFolder',
+                                                             '' )
+            return [ ( i, os.path.join( folder, f ), start + i * step )
+                     for i, f in enumerate( images ) ]
+        interlaced = _yes( images.get( 'interlaced', False ) )
+        passes = [0, 1] if interlaced else [0]
+        first, last = images['first'], images['last']
+        result = []
+        for p in passes:
+            for number in range( first, last + 1 ):
+                fname = images['namefmt'].format( **{
+                    'stem' : images['stem'], 'pass' : p, 'number' : number } )
+                i = number - first
+                if p == 1 and _yes( images.get( 'iflip', False ) ):
+                    i = last - number
+                result.append( ( len(result),
+                                 os.path.join( images['folder'], fname ),
+                                 start + step*( i + p / len(passes) ) ) )
+        return result
+
+    def peakstore( self, name, detector, restart=False, background=True ):
+        """
+        The .flt file that peaks for this scan/detector go into
+        background : False for peaks from frames without the background
+                     subtracted (live), these go to a separate _live.flt
+        """
+        peaks = self.processing( name, detector )['Peaks']
+        filename = os.path.join( peaks['folder'], peaks['fltfiles'] )
+        if not background:
+            filename = os.path.splitext( filename )[0] + "_live.flt"
+        return peakstore( filename, restart = restart,
+                          background = background )
+
+
+class peakstore( object ):
+    """
+    A .flt file which is appended to frame by frame.
+    A sidecar file (.done) records the next frame to process and the
+    length of the .flt when that frame was committed, so a restart
+    drops any partial write and does not redo finished frames.
+    An existing .flt without a sidecar (e.g. from an offline peak
+    search) is only replaced when restart is True.
+    background : whether the frames had the background subtracted,
+    kept in the sidecar so peaks of both kinds are never mixed.
+    """
+    def __init__( self, filename, columns=None, restart=False,
+                  background=None ):
+        self.filename = filename
+        self.background = background
+        self.donefile = filename + ".done"
+        self.columns = list( columns or peaksearch.FLT_COLUMNS )
+        self.done = 0
+        nbytes = None
+        if not restart and os.path.exists( filename ) and \
+           not os.path.exists( self.donefile ):
+            raise ValueError( "%s exists and was not written by a peakstore,"
+                              " use restart=True to replace it"%( filename ) )
+        if os.path.exists( self.donefile ) and not restart:
+            state = yaml.safe_load( open( self.donefile, "r" ) )
+            self.done = state['done']
+            nbytes = state['nbytes']
+            self.columns = state['columns']
+            if background is not None and \
+               state.get( 'background', background ) != background:
+                raise ValueError( "%s has peaks with background=%s, use "
+                                  "restart=True to replace them"%(
+                                      filename, state['background'] ) )
+            self.background = state.get( 'background', background )
+        if nbytes is None or not os.path.exists( filename ):
+            if os.path.exists( self.donefile ):
+                os.remove( self.donefile )
+            with open( filename, "w" ) as f:
+                f.write( "#  " + "  ".join( self.columns ) + "\n" )
+            self.done = 0
+        else:
+            with open( filename, "r+" ) as f:
+                f.truncate( nbytes )
+
+    def append( self, index, peaks ):
+        """ Add the peaks (dict of columns) for frame index """
+        assert index == self.done, "frames must be committed in order"
+        block = np.array( [ np.asarray( peaks[c], float )
+                            for c in self.columns ] ).T
+        with open( self.filename, "a" ) as f:
+            if len( block ):
+                np.savetxt( f, block, fmt="%.4f" )
+            f.flush()
+            nbytes = f.tell()
+        self.done = index + 1
+        tmp = self.donefile + ".tmp"
+        with open( tmp, "w" ) as f:
+            f.write( yaml.dump( { 'done' : self.done, 'nbytes' : nbytes,
+                                  'columns' : self.columns,
+                                  'background' : self.background } ) )
+        os.replace( tmp, self.donefile )
+
+    def read( self ):
+        """ All peaks so far as a dict of columns """
+        data = np.loadtxt( self.filename, ndmin=2 ).reshape(
+            -1, len( self.columns ) )
+        return dict( ( c, data[:,i] ) for i, c in enumerate( self.columns ) )
+
+
+# Stages done for each detector of a scan, in order
+DETECTOR_STAGES = [ 'Background', 'Peaks', 'Geometry' ]
+# Stages done once per scan, after all of the detectors
+SCAN_STAGES = [ 'Refinement' ]
+
+
+def stage_graph( prj ):
+    """
+    The stages found in the processing section of a project
+    Returns a dict of node -> ( stage, scan, detector, options, [deps] )
+    with node names like "scan_2/frelon21/Peaks" or "scan_2/Refinement"
+    """
+    nodes = {}
+    processing = prj.stuff['Experiment'].get( 'processing', {} ) or {}
+    for scan in processing:
+        last = []
+        for detector in processing[scan]:
+            if detector in SCAN_STAGES:
+                continue
+            block = processing[scan][detector] or {}
+            prev = []
+            for stage in DETECTOR_STAGES:
+                if stage in block:
+                    node = "%s/%s/%s"%( scan, detector, stage )
+                    nodes[node] = ( stage, scan, detector, block[stage], prev )
+                    prev = [ node ]
+            last += prev
+        for stage in SCAN_STAGES:
+            if stage in processing[scan]:
+                node = "%s/%s"%( scan, stage )
+                nodes[node] = ( stage, scan, None, processing[scan][stage],
+                                last )
+                last = [ node ]
+    return nodes
+
+
+def background_stage( prj, scan, detector, options ):
+    """ Median of the corrected frames (every step'th one) """
+    corr = images.from_project( prj, scan, detector )
+    step = options.get( 'step', 10 )
+    names = [ f[1] for f in prj.frames( scan, detector ) ][::step]
+    stack = np.array( list( corr.frames( names ) ) )
+    import fabio.edfimage
+    fabio.edfimage.edfimage( data = np.median( stack, axis=0 ).astype(
+        np.float32 ) ).write( background_file( prj, scan, detector ) )
+    return len( names )
+
+
+def background_file( prj, scan, detector ):
+    bg = prj.processing( scan, detector )['Background']
+    folder = prj.processing( scan, detector ).get( 'Peaks', {} ).get(
+        'folder', '' )
+    return os.path.join( folder, bg['median'] )
+
+
+def peaks_stage( prj, scan, detector, options ):
+    """ Corrected, background subtracted frames to the peak store """
+    corr = images.from_project( prj, scan, detector )
+    bg = None
+    if 'Background' in prj.processing( scan, detector ):
+        bg = images.read_image( background_file( prj, scan, detector ) )[0]
+    threshold = min( options['thresholds'] )
+    store = prj.peakstore( scan, detector,
+                           restart = options.get( 'restart', False ),
+                           background = bg is not None )
+    frames = [ f for f in prj.frames( scan, detector ) if f[0] >= store.done ]
+    for ( index, _, omega ), im in zip( frames, corr.frames(
+            [ f[1] for f in frames ] ) ):
+        if bg is not None:
+            im = im - bg
+        store.append( index, peaksearch.frame_peaks( im, threshold, omega ) )
+    return len( frames )
+
+
+STAGE_FUNCTIONS = { 'Background' : background_stage,
+                    'Peaks' : peaks_stage }
+
+
+def _run_stage( func, prj, scan, detector, options ):
+    """ Worker: run one stage and time it """
+    t0 = time.time()
+    count = func( prj, scan, detector, options )
+    return time.time() - t0, count
+
+
+class scheduler( object ):
+    """
+    Runs the processing stages of a project on a process pool.
+    Independent scans and detectors go in parallel, a stage starts
+    when the ones it depends on are finished. Finished stages are
+    recorded in a state file so a rerun after a failure only does
+    what is left.
+    """
+    def __init__( self, prj, stages=None, statefile=None ):
+        """
+        stages : dict of stage name -> func( prj, scan, detector, options )
+                 returning the number of items done (for throughput).
+                 Must be picklable. Defaults to STAGE_FUNCTIONS.
+        """
+        if not isinstance( prj, project ):
+            prj = project( prj )
+        self.prj = prj
+        self.stages = dict( STAGE_FUNCTIONS )
+        if stages is not None:
+            self.stages.update( stages )
+        self.nodes = stage_graph( prj )
+        for node in self.nodes:
+            if self.nodes[node][0] not in self.stages:
+                raise KeyError( "No function for stage %s"%( node ) )
+        self.statefile = statefile
+        self.done = {}
+        self.failed = {}
+        if statefile is not None and os.path.exists( statefile ):
+            state = yaml.safe_load( open( statefile, "r" ) ) or {}
+            self.done = state.get( 'done', {} )
+
+    def save( self ):
+        if self.statefile is None:
+            return
+        tmp = self.statefile + ".tmp"
+        with open( tmp, "w" ) as f:
+            f.write( yaml.dump( { 'done' : self.done,
+                                  'failed' : self.failed } ) )
+        os.replace( tmp, self.statefile )
+
+    def ready( self, running ):
+        """ Nodes which can start now """
+        return [ node for node in self.nodes
+                 if node not in self.done and node not in self.failed
+                 and node not in running
+                 and all( [ d in self.done for d in self.nodes[node][4] ] ) ]
+
+    def blocked( self ):
+        """ Nodes which cannot run because something they need failed """
+        bad = set( self.failed )
+        changed = True
+        while changed:
+            changed = False
+            for node in self.nodes:
+                if node not in bad and any( [ d in bad for d in
+                                              self.nodes[node][4] ] ):
+                    bad.add( node )
+                    changed = True
+        return sorted( bad - set( self.failed ) )
+
+    def run( self, processes=None, executor=None ):
+        """ Run everything not already done. Returns the report """
+        self.failed = {}
+        own = executor is None
+        if own:
+            executor = concurrent.futures.ProcessPoolExecutor( processes )
+        running = {}
+        try:
+            while True:
+                for node in self.ready( running.values() ):
+                    stage, scan, detector, options, _ = self.nodes[node]
+                    job = executor.submit( _run_stage, self.stages[stage],
+                                           self.prj, scan, detector, options )
+                    running[job] = node
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(
+                    list( running ),
+                    return_when = concurrent.futures.FIRST_COMPLETED )
+                for job in finished:
+                    node = running.pop( job )
+                    try:
+                        seconds, count = job.result()
+                        self.done[node] = { 'seconds' : float( seconds ),
+                                            'count' : count }
+                    except Exception:
+                        self.failed[node] = traceback.format_exc()
+                    self.save()
+        finally:
+            if own:
+                executor.shutdown()
+        return self.report()
+
+    def report( self ):
+        """ Per stage time and throughput """
+        lines = []
+        blocked = self.blocked()
+        for node in self.nodes:
+            if node in self.done:
+                d = self.done[node]
+                rate = ""
+                if d['count'] and d['seconds'] > 0:
+                    rate = "%.1f /s"%( d['count'] / d['seconds'] )
+                lines.append( "%-40s done %8.2f s  %s"%( node, d['seconds'],
+                                                         rate ) )
+            elif node in self.failed:
+                lines.append( "%-40s FAILED"%( node ) )
+            elif node in blocked:
+                lines.append( "%-40s blocked"%( node ) )
+            else:
+                lines.append( "%-40s not run"%( node ) )
+        return "\n".join( lines )
+
 
 if __name__ == "__main__":
     import sys
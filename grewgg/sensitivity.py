@@ -0,0 +1,110 @@
+
+from __future__ import print_function, division
+
+"""
+How errors in the motors of an instrument move things in the lab
+
+For a stack like EH1_Detector_Tower applied to the pixels of a
+detector, or 3DXRD_Huber_Tower applied to a grid of grain positions:
+
+- displacements : d(xyz)/d(axis) for each axis at every point. The
+  stack is affine in the vectors, so only the derivative matrices
+  are found by differences (one batch of 2P matrices) and then
+  applied to all of the points at once.
+
+- tolerance : Monte-Carlo over many configurations with normally
+  distributed errors on the axes, evaluated as batches of matrices.
+  Gives the rms and the largest displacement of each point. Works on
+  blocks of configurations and points to stay within a memory budget.
+
+Axis errors are in the units of the parameters (degrees for motor
+rotations, radians for the fable tilts, the units of the axis for
+translations).
+"""
+
+import numpy as np
+
+
+def pixel_grid( shape, step=1 ):
+    """ (3,N) detector vectors ( 0, fc, sc ) on a grid of pixels """
+    sc, fc = np.mgrid[ 0:shape[0]:step, 0:shape[1]:step ]
+    sc = sc.ravel().astype( float )
+    return np.array( [ np.zeros_like( sc ), fc.ravel(), sc ] )
+
+
+def position_grid( x, y, z ):
+    """ (3,N) vectors for all combinations of x, y, z """
+    gx, gy, gz = np.meshgrid( x, y, z, indexing='ij' )
+    return np.array( [ gx.ravel(), gy.ravel(), gz.ravel() ], float )
+
+
+def derivatives( inst, axes, steps=1e-6 ):
+    """
+    (P,4,4) derivatives of the instrument matrix for each axis by
+    central differences, steps is a scalar or one per axis
+    """
+    axes = list( axes )
+    steps = np.broadcast_to( np.asarray( steps, float ), ( len( axes ), ) )
+    batch = {}
+    for j, a in enumerate( axes ):
+        base = float( inst.get( a ) )
+        col = np.full( 2 * len( axes ), base )
+        col[ 2*j ] += steps[j]
+        col[ 2*j + 1 ] -= steps[j]
+        batch[ a ] = col
+    m4 = inst.batch_mat4( batch )
+    return ( m4[0::2] - m4[1::2] ) / ( 2 * steps[:, np.newaxis, np.newaxis] )
+
+
+def displacements( inst, v, axes, steps=1e-6 ):
+    """
+    (P,3,N) movement of each point of v (3,N) per unit error on each
+    of the axes
+    """
+    dm = derivatives( inst, axes, steps )
+    out = np.matmul( dm[:, :3, :3], np.asarray( v, float ) )
+    out += dm[:, :3, 3, np.newaxis]
+    return out
+
+
+def tolerance( inst, v, sigmas, nconfig=1000, seed=0, chunk=64,
+               maxbytes=2**28 ):
+    """
+    Monte-Carlo tolerance sweep
+    sigmas : dict of axis name -> standard deviation of its error
+    nconfig : number of perturbed configurations
+    chunk : most configurations evaluated together
+    maxbytes : memory for the (k,3,n) block of displacements, the
+               configurations and points are split so that k*3*n*8
+               stays below it (a 2048x2048 detector is 100 MB for
+               a single configuration)
+    Returns dict of rms (N,) and max (N,) displacement of each point
+    and the (nconfig,) rms over the points of each configuration
+    """
+    v = np.asarray( v, float )
+    npts = v.shape[1]
+    rng = np.random.RandomState( seed )
+    names = list( sigmas )
+    # all of the errors first, so the result does not depend on blocking
+    errs = dict( ( a, float( inst.get( a ) ) +
+                   rng.normal( 0, sigmas[a], nconfig ) ) for a in names )
+    n = max( 1, min( npts, maxbytes // ( 3 * 8 ) ) )
+    k = max( 1, min( chunk, maxbytes // ( 3 * 8 * n ) ) )
+    sum2 = np.zeros( npts )
+    big = np.zeros( npts )
+    per_config = np.zeros( nconfig )
+    for p0 in range( 0, npts, n ):
+        vb = v[:, p0 : p0 + n]
+        base = inst( vb )
+        for k0 in range( 0, nconfig, k ):
+            batch = dict( ( a, errs[a][k0 : k0 + k] ) for a in names )
+            d = inst.batch( vb, batch, observed = base )    # (k,3,n)
+            np.multiply( d, d, out = d )
+            d2 = d.sum( axis=1 )                             # (k,n)
+            sum2[p0 : p0 + n] += d2.sum( axis=0 )
+            np.maximum( big[p0 : p0 + n], d2.max( axis=0 ),
+                        out = big[p0 : p0 + n] )
+            per_config[k0 : k0 + k] += d2.sum( axis=1 )
+    return { 'rms' : np.sqrt( sum2 / nconfig ),
+             'max' : np.sqrt( big ),
+             'config_rms' : np.sqrt( per_config / npts ) }
@@ -0,0 +1,150 @@
+
+from __future__ import print_function, division
+
+"""
+Peak columns in shared memory for multiprocessing workers
+
+The process which creates the columns owns them and removes the
+shared memory when it is closed (or garbage collected). Workers
+get a small picklable spec and attach to the same memory, so the
+(3,N) arrays are never copied or pickled.
+
+    with shared.columns( { 'sc' : sc, 'fc' : fc } ) as cols:
+        xyz = cols.add( 'xyz', (3, len(sc)) )
+        pool.map( work, [ (cols.spec(), i0, i1) for ... ] )
+
+    def work( args ):
+        spec, i0, i1 = args
+        cols = shared.attach( spec )
+        cols['xyz'][:, i0:i1] = geometry( ... cols['sc'][i0:i1] ... )
+"""
+
+import os, sys, weakref, multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def _owner():
+    """ Identifies the creating process and its resource tracker """
+    tracker = None
+    if sys.version_info < (3, 13):
+        from multiprocessing import resource_tracker
+        tracker = getattr( resource_tracker._resource_tracker, "_pid", None )
+    return ( os.getpid(), tracker )
+
+
+def _shares_tracker( owner ):
+    """ True if this process uses the resource tracker of the owner:
+    the owner itself, its multiprocessing children (fork or spawn both
+    pass the tracker on) or forked descendants """
+    pid, tracker = owner
+    if os.getpid() == pid:
+        return True
+    parent = multiprocessing.parent_process()
+    if parent is not None and parent.pid == pid:
+        return True
+    from multiprocessing import resource_tracker
+    return tracker is not None and tracker == getattr(
+        resource_tracker._resource_tracker, "_pid", None )
+
+
+def _open( name, owner ):
+    """ Attach to an existing block. A process with its own resource
+    tracker must not leave the block registered there, or the block is
+    removed when that process exits. A tracker shared with the owner
+    keeps the registration: the owner unregisters it when it unlinks,
+    and the tracker still cleans up if the owner dies """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory( name=name, track=False )
+    shared = _shares_tracker( owner )
+    shm = shared_memory.SharedMemory( name=name )
+    if not shared:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister( shm._name, "shared_memory" )
+    return shm
+
+
+def _release( blocks, unlink ):
+    for shm in blocks.values():
+        try:
+            shm.close()
+        except BufferError:
+            # numpy views still exist, the mapping goes with the process
+            pass
+        if unlink:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+    blocks.clear()
+
+
+class columns( object ):
+    """ Named numpy arrays, each in a shared memory block """
+    def __init__( self, arrays=None, spec=None ):
+        """
+        arrays : dict of name -> array to copy into shared memory
+        spec : from columns.spec(), to attach in another process
+        """
+        self.names = []
+        self.blocks = {}
+        self.arrays = {}
+        self.owner = spec is None
+        if spec is not None:
+            for name, shmname, shape, dtype, owner in spec:
+                self._map( name, _open( shmname, owner ), shape, dtype )
+        self._finalizer = weakref.finalize( self, _release, self.blocks,
+                                            self.owner )
+        if arrays is not None:
+            for name in arrays:
+                a = np.asarray( arrays[name] )
+                self.add( name, a.shape, a.dtype )[...] = a
+
+    def _map( self, name, shm, shape, dtype ):
+        self.names.append( name )
+        self.blocks[ name ] = shm
+        self.arrays[ name ] = np.ndarray( shape, dtype=dtype, buffer=shm.buf )
+        return self.arrays[ name ]
+
+    def add( self, name, shape, dtype=float ):
+        """ Allocate a new (zeroed) column, e.g. for computed xyz """
+        assert self.owner, "only the creating process can add columns"
+        assert name not in self.arrays, name
+        dtype = np.dtype( dtype )
+        nbytes = max( int( np.prod( shape ) ) * dtype.itemsize, 1 )
+        shm = shared_memory.SharedMemory( create=True, size=nbytes )
+        a = self._map( name, shm, tuple( shape ), dtype )
+        a[...] = 0
+        return a
+
+    def spec( self ):
+        """ Picklable description to attach from another process """
+        owner = _owner()
+        return [ ( name, self.blocks[name].name, self.arrays[name].shape,
+                   self.arrays[name].dtype.str, owner )
+                 for name in self.names ]
+
+    def __getitem__( self, name ):
+        return self.arrays[ name ]
+
+    def __contains__( self, name ):
+        return name in self.arrays
+
+    def __len__( self ):
+        return len( self.names )
+
+    def close( self ):
+        """ Drop the arrays and release the memory (removed if owner) """
+        self.arrays.clear()
+        self._finalizer()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+
+def attach( spec ):
+    """ Attach to columns created in another process """
+    return columns( spec=spec )
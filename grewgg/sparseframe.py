@@ -0,0 +1,154 @@
+
+from __future__ import print_function, division
+
+"""
+Sparse pixels of a scan
+
+The pixels above the lowest threshold are written once per scan as
+flat arrays (row, col, intensity) with a pointer to the first pixel
+of each frame and the omega of each frame. Peak searches at higher
+thresholds, and connecting peaks across omega, then run from these
+arrays instead of the full frames.
+
+Folder layout:
+   sparse.yml    : shape, threshold, number of frames and pixels
+   row.dat, col.dat : uint16 pixel positions
+   intensity.dat : float32 values
+   frames.npy    : (nframes+1) pointers into the pixel arrays
+   omega.npy     : motor position of each frame
+"""
+
+import os
+import yaml
+import numpy as np
+from . import peaksearch
+
+FILES = ( ( 'row', np.uint16 ), ( 'col', np.uint16 ),
+          ( 'intensity', np.float32 ) )
+
+
+class sparsewriter( object ):
+    """ Appends the pixels above threshold of each frame """
+    def __init__( self, folder, shape, threshold ):
+        if not os.path.isdir( folder ):
+            os.makedirs( folder )
+        self.folder = folder
+        self.shape = tuple( int(s) for s in shape )
+        assert max( self.shape ) < 2**16, "pixel positions are uint16"
+        self.threshold = float( threshold )
+        self.files = dict( ( name, open( os.path.join( folder, name + ".dat" ),
+                                         "wb" ) ) for name, _ in FILES )
+        self.ptr = [ 0 ]
+        self.omega = []
+
+    def add( self, image, omega ):
+        """ Add the next frame """
+        image = np.asarray( image )
+        assert image.shape == self.shape
+        rows, cols = np.nonzero( image > self.threshold )
+        for name, dtype in FILES:
+            if name == 'row':
+                a = rows
+            elif name == 'col':
+                a = cols
+            else:
+                a = image[ rows, cols ]
+            self.files[name].write( a.astype( dtype ).tobytes() )
+        self.ptr.append( self.ptr[-1] + len( rows ) )
+        self.omega.append( float( omega ) )
+
+    def close( self ):
+        for f in self.files.values():
+            f.close()
+        np.save( os.path.join( self.folder, "frames.npy" ),
+                 np.array( self.ptr, np.int64 ) )
+        np.save( os.path.join( self.folder, "omega.npy" ),
+                 np.array( self.omega ) )
+        with open( os.path.join( self.folder, "sparse.yml" ), "w" ) as f:
+            f.write( yaml.dump( { 'shape' : list( self.shape ),
+                                  'threshold' : self.threshold,
+                                  'nframes' : len( self.omega ),
+                                  'npixels' : int( self.ptr[-1] ) } ) )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+
+def write( folder, frames, omegas, threshold ):
+    """ Write an iterable of frames (e.g. images.correction.frames) """
+    writer = None
+    for image, omega in zip( frames, omegas ):
+        if writer is None:
+            writer = sparsewriter( folder, np.shape( image ), threshold )
+        writer.add( image, omega )
+    if writer is not None:
+        writer.close()
+    return sparsescan( folder )
+
+
+class sparsescan( object ):
+    """ Memory mapped sparse pixels of a scan """
+    def __init__( self, folder ):
+        self.folder = folder
+        h = yaml.safe_load( open( os.path.join( folder, "sparse.yml" ), "r" ) )
+        self.shape = tuple( h['shape'] )
+        self.threshold = h['threshold']
+        self.nframes = h['nframes']
+        self.npixels = h['npixels']
+        self.ptr = np.load( os.path.join( folder, "frames.npy" ) )
+        self.omega = np.load( os.path.join( folder, "omega.npy" ) )
+        for name, dtype in FILES:
+            if self.npixels:
+                a = np.memmap( os.path.join( folder, name + ".dat" ),
+                               dtype=dtype, mode="r", shape=( self.npixels, ) )
+            else:
+                a = np.zeros( 0, dtype )
+            setattr( self, name, a )
+
+    def frame( self, i ):
+        """ rows, cols, intensity of frame i """
+        s = slice( self.ptr[i], self.ptr[i+1] )
+        return self.row[s], self.col[s], self.intensity[s]
+
+    def dense( self, i ):
+        """ Frame i as an image (zero below the threshold) """
+        im = np.zeros( self.shape, np.float32 )
+        r, c, v = self.frame( i )
+        im[ r, c ] = v
+        return im
+
+    def peaks( self, threshold=None, omega_connect=False, first=0, last=None ):
+        """
+        Peak search from the sparse pixels of frames first:last
+        threshold : must not be below the one used for writing
+        omega_connect : join peaks touching in consecutive frames
+        Returns a dict of .flt columns (omega is intensity weighted)
+        """
+        if threshold is None:
+            threshold = self.threshold
+        assert threshold >= self.threshold, "pixels below %f were not kept"%(
+            self.threshold )
+        if last is None:
+            last = self.nframes
+        p0, p1 = self.ptr[first], self.ptr[last]
+        frame = np.repeat( np.arange( first, last ),
+                           np.diff( self.ptr[first:last+1] ) )
+        values = np.asarray( self.intensity[p0:p1] )
+        keep = values > threshold
+        rows = self.row[p0:p1][keep].astype( np.int64 )
+        cols = self.col[p0:p1][keep].astype( np.int64 )
+        values = values[keep]
+        frame = frame[keep]
+        # pad rows and columns so neighbours do not wrap between them
+        W = self.shape[1] + 1
+        F = ( self.shape[0] + 1 ) * W
+        keys = frame * F + rows * W + cols
+        offsets = peaksearch.neighbours_2d( self.shape[1] )
+        if omega_connect:
+            offsets = offsets + [ F ]
+        labels, n = peaksearch.label_keys( keys, offsets )
+        return peaksearch.moments( labels, n, rows, cols, values,
+                                   self.omega[ frame ] )
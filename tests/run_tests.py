@@ -8,7 +8,20 @@ sys.path.insert(0,"..")
 
 modules = [
     "test_general_geometry",
-    "test_positioners"
+    "test_positioners",
+    "test_errors",
+    "test_shared",
+    "test_peaksearch",
+    "test_live",
+    "test_images",
+    "test_cache",
+    "test_projects",
+    "test_calibration",
+    "test_grainmap",
+    "test_sparseframe",
+    "test_diffraction",
+    "test_parfile",
+    "test_sensitivity"
 ]
 
 HERE = os.getcwd()
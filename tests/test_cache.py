@@ -0,0 +1,72 @@
+
+from __future__ import print_function, division
+
+import os, unittest, tempfile, shutil, time
+import numpy as np
+
+from grewgg import cache
+
+calls = []
+
+def stage( pars, fltfile ):
+    """ pretend to compute something from a file """
+    calls.append( pars )
+    data = np.loadtxt( fltfile, ndmin=2 )
+    return { 'xyz' : data * pars['distance'] }
+
+
+class test_stagecache( unittest.TestCase ):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.c = cache.stagecache( os.path.join( self.folder, "cache" ) )
+        self.flt = os.path.join( self.folder, "a.flt" )
+        np.savetxt( self.flt, np.ones( (4, 3) ) )
+        del calls[:]
+
+    def tearDown(self):
+        shutil.rmtree( self.folder )
+
+    def run_stage(self, pars):
+        return self.c.run( stage, args = ( pars, self.flt ),
+                           files = [ self.flt ] )
+
+    def test_hit(self):
+        r1 = self.run_stage( { 'distance' : 2.0 } )
+        r2 = self.run_stage( { 'distance' : 2.0 } )
+        assert len( calls ) == 1 and self.c.hits == 1
+        assert np.allclose( r1['xyz'], r2['xyz'] )
+        self.run_stage( { 'distance' : 3.0 } )
+        assert len( calls ) == 2
+        # file rewritten
+        time.sleep( 0.01 )
+        np.savetxt( self.flt, np.ones( (5, 3) ) )
+        r3 = self.run_stage( { 'distance' : 2.0 } )
+        assert len( calls ) == 3 and r3['xyz'].shape == (5, 3)
+
+    def test_key(self):
+        k1 = cache.key( { 'a' : 1, 'b' : np.arange(3) }, [1.0, "x"] )
+        k2 = cache.key( { 'b' : np.arange(3), 'a' : 1 }, [1.0, "x"] )
+        k3 = cache.key( { 'b' : np.arange(3.), 'a' : 1 }, [1.0, "x"] )
+        assert k1 == k2 and k1 != k3
+        ymlfile = os.path.join( os.path.split( cache.__file__ )[0],
+                                "data", "fable.yml" )
+        t = cache.ymltree( ymlfile, [ "Positioners", "Fable_detector" ] )
+        assert cache.key( t ) != cache.key( cache.ymltree(
+            ymlfile, [ "Positioners", "Fable_diffractometer" ] ) )
+
+    def test_evict(self):
+        c = cache.stagecache( os.path.join( self.folder, "small" ),
+                              maxentries = 2 )
+        for i in range(3):
+            c.put( "k%d"%(i), { 'a' : np.arange(10) } )
+            time.sleep( 0.01 )
+            c.get( "k0" ) # keep k0 recent
+            time.sleep( 0.01 )
+        assert c.get( "k0" ) is not None
+        assert c.get( "k1" ) is None
+        assert c.get( "k2" ) is not None
+
+
+if __name__ ==  "__main__":
+    unittest.main()
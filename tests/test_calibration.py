@@ -0,0 +1,86 @@
+
+from __future__ import print_function, division
+
+import os, unittest
+import numpy as np
+
+from grewgg import calibration, general_geometry, parfile
+
+TEST="./testdata"
+
+
+def simulate( pars, npks=2000, seed=0 ):
+    """ sc, fc of peaks on the rings for a detector """
+    det = general_geometry.from_yml( pars, general_geometry.FABLE_YML,
+                                     [ "Positioners", "Fable_detector" ] )
+    m = det.mat4()
+    rings = calibration.ring_tth( pars, 10.0 )
+    rng = np.random.RandomState( seed )
+    tth = np.radians( rings[ rng.randint( 0, len(rings), npks ) ] )
+    eta = rng.uniform( 0, 2*np.pi, npks )
+    k = np.array( [ np.cos(tth), -np.sin(tth)*np.sin(eta),
+                    np.sin(tth)*np.cos(eta) ] )
+    # s.k = m[:3,1]*fc + m[:3,2]*sc + t
+    A = np.zeros( (npks, 3, 3) )
+    A[:,:,0] = k.T
+    A[:,:,1] = -m[:3,1]
+    A[:,:,2] = -m[:3,2]
+    s, fc, sc = np.linalg.solve( A, np.repeat( m[np.newaxis,:3,3:], npks,
+                                               axis=0 ) )[...,0].T
+    return sc, fc
+
+
+class test_calibration( unittest.TestCase ):
+
+    def setUp(self):
+        self.pars = parfile.read_par_file( os.path.join( TEST, "test0.par" ) )
+        self.pars['tilt_y'] = 0.01
+        self.pars['tilt_z'] = -0.005
+
+    def test_rings(self):
+        # Al, F centred: 111, 200, 220, 311
+        tth = calibration.ring_tth( self.pars, 20.0 )
+        d = self.pars['wavelength'] / 2 / np.sin( np.radians( tth ) / 2 )
+        a = self.pars['cell__a']
+        expected = a / np.sqrt( [ 3, 4, 8, 11, 12, 16, 19, 20, 24 ] )
+        assert np.allclose( d[:len(expected)], expected )
+
+    def test_fit(self):
+        sc, fc = simulate( self.pars )
+        start = dict( self.pars )
+        start['distance'] += 500.
+        start['y_center'] += 2.
+        start['z_center'] -= 1.
+        start['tilt_y'] += 0.002
+        free = [ 'distance', 'y_center', 'z_center', 'tilt_y', 'tilt_z' ]
+        cal = calibration.calibration( start, sc, fc, free )
+        assert cal.mask.sum() > 1900
+        cal.fit()
+        for name in free:
+            assert np.allclose( cal.pars[name], self.pars[name],
+                                rtol=1e-6, atol=1e-6 ), name
+            assert cal.errors[name] < 1e-3
+        assert cal.chi2 < 1e-12
+        assert np.allclose( cal.detector.mat4(),
+            general_geometry.from_yml( self.pars, general_geometry.FABLE_YML,
+                [ "Positioners", "Fable_detector" ] ).mat4() )
+
+    def test_reassign(self):
+        # far enough off that the first ring is taken for the second
+        sc, fc = simulate( self.pars )
+        start = dict( self.pars )
+        start['distance'] -= 17000.
+        free = [ 'distance', 'y_center', 'z_center', 'tilt_y', 'tilt_z' ]
+        true = calibration.calibration( self.pars, sc, fc, free, tolerance=0.7 )
+        cal = calibration.calibration( start, sc, fc, free, tolerance=0.7 )
+        assert ( ( cal.ring != true.ring ) & cal.mask ).sum() > 100
+        cal.fit()
+        assert cal.npeaks == 2000
+        assert np.array_equal( cal.ring, true.ring )
+        assert np.allclose( cal.pars['distance'], self.pars['distance'],
+                            rtol=1e-6 )
+        assert cal.chi2 < 1e-12
+
+
+if __name__ ==  "__main__":
+    unittest.main()
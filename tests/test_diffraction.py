@@ -0,0 +1,74 @@
+
+from __future__ import print_function, division
+
+import os, unittest
+import numpy as np
+
+from grewgg import general_geometry, diffraction, positioners, parfile
+
+TEST="./testdata"
+
+
+class test_scattering( unittest.TestCase ):
+
+    def setUp(self):
+        try:
+            from ImageD11 import columnfile
+        except ImportError:
+            raise unittest.SkipTest( "no ImageD11" )
+        self.pars = parfile.read_par_file( os.path.join( TEST, "test0.par" ) )
+        self.colf = columnfile.columnfile( os.path.join( TEST, "test.flt" ) )
+
+    def compute(self):
+        c = self.colf
+        path = [ "Positioners", "Fable_detector" ]
+        det = general_geometry.from_yml( self.pars, general_geometry.FABLE_YML,
+                                         path )
+        path = [ "Positioners", "Fable_diffractometer" ]
+        sam = general_geometry.from_yml( self.pars, general_geometry.FABLE_YML,
+                                         path )
+        xyz = det( np.array( [ np.zeros( c.nrows ), c.fc, c.sc ] ) )
+        return diffraction.scattering( xyz, sam, self.pars['wavelength'],
+                                       { 'omega' : c.omega } )
+
+    def test_imaged11(self):
+        from ImageD11 import transform
+        c = self.colf
+        self.pars['t_x'] = 10.
+        self.pars['t_y'] = -20.
+        tth, eta, g = self.compute()
+        t1, e1 = transform.compute_tth_eta( ( c.sc, c.fc ), omega = c.omega,
+                                            **self.pars )
+        g1 = transform.compute_g_vectors( t1, e1, c.omega,
+                                          self.pars['wavelength'] )
+        assert np.allclose( tth, t1 )
+        assert np.allclose( eta, e1 )
+        assert np.allclose( g, g1 )
+
+    def test_wedge(self):
+        from ImageD11 import transform
+        c = self.colf
+        self.pars['wedge'] = 2.0
+        tth, eta, g = self.compute()
+        # ImageD11 wedge has the opposite sense to a rotation about +y
+        g1 = transform.compute_g_vectors( tth, eta, c.omega,
+                                          self.pars['wavelength'], wedge=-2.0 )
+        assert np.allclose( g, g1 )
+
+    def test_beam_direction(self):
+        # the same experiment turned so the beam is along z
+        r = np.array( [ [0, 0, -1], [0, 1, 0], [1, 0, 0] ], float )
+        rng = np.random.RandomState( 5 )
+        xyz = rng.normal( size = (3, 20) ) + [ [100], [0], [0] ]
+        sam = positioners.positioner( "fixed" )
+        t1, e1, g1 = diffraction.scattering( xyz, sam, 0.5 )
+        sam2 = positioners.positioner( "turned", np.eye(4) )
+        sam2.m4[:3,:3] = r
+        t2, e2, g2 = diffraction.scattering( np.dot( r, xyz ), sam2, 0.5,
+                                             direction = np.dot( r, [1,0,0] ) )
+        assert np.allclose( t1, t2 )
+        assert np.allclose( g1, g2 )
+
+
+if __name__ ==  "__main__":
+    unittest.main()
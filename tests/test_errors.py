@@ -0,0 +1,73 @@
+
+from __future__ import print_function, division
+
+import unittest
+import numpy as np
+
+from grewgg import errors
+
+
+def linefit( x, y ):
+    """ fit y = a*x + b , module level so it can go to a pool """
+    A = np.array( [ x, np.ones_like(x) ] ).T
+    return np.linalg.lstsq( A, y, rcond=None )[0]
+
+
+class test_covariance( unittest.TestCase ):
+
+    def setUp(self):
+        rng = np.random.RandomState( 42 )
+        self.x = np.linspace( 0, 10, 200 )
+        self.y = 3.0 * self.x + 1.0 + rng.normal( 0, 0.1, len(self.x) )
+
+    def test_jacobian(self):
+        f = lambda p : p[0]*self.x + p[1] - self.y
+        r, J = errors.jacobian( f, [3.0, 1.0] )
+        assert J.shape == (len(self.x), 2)
+        assert np.allclose( J[:,0], self.x, atol=1e-4 )
+        assert np.allclose( J[:,1], 1, atol=1e-4 )
+
+    def test_linear(self):
+        p = linefit( self.x, self.y )
+        f = lambda pp : pp[0]*self.x + pp[1] - self.y
+        r, J = errors.jacobian( f, p )
+        cov = errors.covariance( J, r )
+        # analytic result for a straight line
+        A = np.array( [ self.x, np.ones_like(self.x) ] ).T
+        s2 = (r*r).sum() / (len(r) - 2)
+        assert np.allclose( cov, s2 * np.linalg.inv( np.dot( A.T, A ) ),
+                            rtol=1e-4 )
+        e = errors.uncertainties( cov )
+        assert np.allclose( errors.correlation( cov ).diagonal(), 1 )
+        assert e[0] < 0.01 and e[1] < 0.05
+
+    def test_bootstrap(self):
+        p1 = errors.bootstrap( linefit, ( self.x, self.y ), nboot=20,
+                               processes=1 )
+        p2 = errors.bootstrap( linefit, ( self.x, self.y ), nboot=20,
+                               processes=2 )
+        assert p1.shape == (20, 2)
+        assert np.allclose( p1, p2 )
+        std, cov = errors.bootstrap_errors( linefit, ( self.x, self.y ),
+                                            nboot=50, processes=1 )
+        assert std.shape == (2,) and cov.shape == (2,2)
+        assert np.all( std < 0.1 )
+
+    def test_many(self):
+        # two "grains" fitted from their own peaks with one pool
+        y = np.where( self.x < 5, self.y, -2 * self.x + 4 )
+        grains = [ np.nonzero( self.x < 5 )[0], np.nonzero( self.x >= 5 )[0] ]
+        with errors.bootstrapper( linefit, ( self.x, y ), processes=2 ) as b:
+            p2 = b.many( grains, nboot=10 )
+            one = b( grains[1], nboot=10 )
+        with errors.bootstrapper( linefit, ( self.x, y ), processes=1 ) as b:
+            p1 = b.many( grains, nboot=10 )
+        assert len( p2 ) == 2 and p2[0].shape == (10, 2)
+        assert np.allclose( p1[0], p2[0] ) and np.allclose( p1[1], p2[1] )
+        assert np.allclose( one, p2[1] )
+        assert np.allclose( p2[0].mean( axis=0 ), [3, 1], atol=0.05 )
+        assert np.allclose( p2[1], [-2, 4] )
+
+
+if __name__ ==  "__main__":
+    unittest.main()
@@ -5,8 +5,8 @@ from __future__ import print_function, division
 import sys, os, unittest
 import numpy as np
 
-from ImageD11 import parameters, columnfile, transform
-from grewgg import general_geometry
+from ImageD11 import columnfile, transform
+from grewgg import general_geometry, parfile
 
 TEST="./testdata"
 
@@ -16,9 +16,9 @@ class test_xyz_match( unittest.TestCase ):
     
     def test_xyz(self):
         for p in parfiles:
-            parfile = os.path.join( TEST,  p )
+            fname = os.path.join( TEST,  p )
             fltfile = os.path.join( TEST,  "test.flt" )
-            pars = parameters.read_par_file( parfile ).parameters
+            pars = parfile.read_par_file( fname )
             colf = columnfile.columnfile( fltfile )
             sc = colf.sc
             fc = colf.fc
@@ -44,13 +44,13 @@ class test_xyz_match( unittest.TestCase ):
 
     def test_xyz_from_yaml(self):
         for p in parfiles:
-            parfile = os.path.join( TEST,  p )
+            fname = os.path.join( TEST,  p )
             fltfile = os.path.join( TEST,  "test.flt" )
             ymlfile = os.path.join(
                 os.path.split(general_geometry.__file__)[0],
                 "data",
                 "fable.yml" )
-            pars = parameters.read_par_file( parfile ).parameters
+            pars = parfile.read_par_file( fname )
             colf = columnfile.columnfile( fltfile )
             sc = colf.sc[:4]
             fc = colf.fc[:4]
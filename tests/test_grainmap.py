@@ -0,0 +1,97 @@
+
+from __future__ import print_function, division
+
+import os, unittest, tempfile, shutil
+import numpy as np
+
+from grewgg import grainmap
+
+
+class test_grainmap( unittest.TestCase ):
+
+    def setUp(self):
+        self.folder = os.path.join( tempfile.mkdtemp(), "map" )
+
+    def tearDown(self):
+        shutil.rmtree( os.path.dirname( self.folder ) )
+
+    def test_write_reopen(self):
+        gm = grainmap.grainmap( self.folder, npeaks=1000, chunk=4 )
+        for gid in range( 10 ):
+            gm.write( gid * 3, np.eye(3) * (gid+1), [gid, 0, 0],
+                      peaks = np.arange( gid * 50, gid * 50 + 50 ) )
+        gm.flush()
+        size = os.path.getsize( os.path.join( self.folder, "grains.dat" ) )
+        assert size == 12 * grainmap.RECORD.itemsize
+        del gm
+        gm = grainmap.grainmap( self.folder )
+        assert len( gm ) == 10 and gm.npeaks == 1000
+        assert np.allclose( gm[9]['ubi'], np.eye(3) * 4 )
+        assert gm[9]['npeaks'] == 50
+        assert np.allclose( gm.peaks( 9 ), np.arange( 150, 200 ) )
+        assert ( gm.assign[500:] == -1 ).all()
+
+    def test_update(self):
+        gm = grainmap.grainmap( self.folder, npeaks=100 )
+        gm.write( 1, np.eye(3), [0, 0, 0], peaks = [1, 2, 3] )
+        gm.write( 2, np.eye(3), [0, 0, 0], peaks = [4, 5] )
+        gm.flush()
+        slot = gm.index[1]
+        gm.write( 1, 2 * np.eye(3), [1, 1, 1], errors = np.ones(12),
+                  peaks = [ 3, 7 ], chi2 = 0.5 )
+        assert gm.index[1] == slot and len( gm ) == 2
+        assert np.allclose( gm.peaks( 1 ), [3, 7] )
+        assert np.allclose( gm.peaks( 2 ), [4, 5] )
+        assert gm.assign[1] == -1
+        t = gm.table()
+        assert np.allclose( t['id'], [1, 2] )
+        assert np.allclose( t['translation'][0], 1 ) and t['chi2'][0] == 0.5
+        gm.remove( 2 )
+        gm.flush()
+        gm = grainmap.grainmap( self.folder )
+        assert gm.ids() == [1] and ( gm.assign[4:6] == -1 ).all()
+
+    def test_take_peaks(self):
+        gm = grainmap.grainmap( self.folder, npeaks=100 )
+        gm.write( 1, np.eye(3), [0, 0, 0], peaks = [2, 3, 4] )
+        gm.flush()
+        gm = grainmap.grainmap( self.folder )
+        # grain 2 takes peaks 3 and 4 from grain 1
+        gm.write( 2, np.eye(3), [0, 0, 0], peaks = [3, 4] )
+        assert gm[1]['npeaks'] == 1 and gm[2]['npeaks'] == 2
+        assert np.allclose( gm.peaks( 1 ), [2] )
+        gm.flush()
+        gm = grainmap.grainmap( self.folder )
+        assert np.allclose( gm.peaks( 1 ), [2] )
+        assert np.allclose( gm.peaks( 2 ), [3, 4] )
+        assert gm[1]['npeaks'] == 1
+
+    def test_peak_lists_in_place(self):
+        gm = grainmap.grainmap( self.folder, npeaks=1000 )
+        for gid in range( 5 ):
+            gm.write( gid, np.eye(3), [0, 0, 0],
+                      peaks = np.arange( gid * 100, gid * 100 + 100 ) )
+        gm.flush()
+        fname = os.path.join( self.folder, "peaks.dat" )
+        size = os.path.getsize( fname )
+        assert size == 500 * 8
+        # fewer peaks fit where the list was
+        gm.write( 3, np.eye(3), [0, 0, 0], peaks = np.arange( 300, 350 ) )
+        assert os.path.getsize( fname ) == size
+        # more peaks are appended, taking some from grain 4
+        gm.write( 3, np.eye(3), [0, 0, 0], peaks = np.arange( 300, 420 ) )
+        gm.flush()
+        assert os.path.getsize( fname ) == size + 120 * 8
+        gm = grainmap.grainmap( self.folder )
+        assert np.allclose( gm.peaks( 3 ), np.arange( 300, 420 ) )
+        assert np.allclose( gm.peaks( 4 ), np.arange( 420, 500 ) )
+        assert gm[4]['npeaks'] == 80
+        assert np.allclose( gm.peaks( 2 ), np.arange( 200, 300 ) )
+        assert ( gm.assign[300:420] == 3 ).all()
+
+    def test_new_needs_npeaks(self):
+        self.assertRaises( ValueError, grainmap.grainmap, self.folder )
+
+
+if __name__ ==  "__main__":
+    unittest.main()
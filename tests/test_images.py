@@ -0,0 +1,79 @@
+
+from __future__ import print_function, division
+
+import os, unittest, tempfile, shutil
+import numpy as np
+
+from grewgg import images
+
+
+class test_correction( unittest.TestCase ):
+
+    def setUp(self):
+        rng = np.random.RandomState( 1 )
+        self.dark = rng.uniform( 90, 110, (100, 60) )
+        self.flood = rng.uniform( 0.8, 1.2, (100, 60) )
+        self.raw = rng.randint( 100, 5000, (3, 100, 60) ).astype( np.uint16 )
+
+    def reference(self, raw, norm):
+        return ( raw - self.dark + 12 ) / self.flood * norm
+
+    def test_frame(self):
+        c = images.correction( dark=self.dark, darkoffset=12,
+                               flood=self.flood, rowblock=7 )
+        out = c( self.raw[0], norm=2.0 )
+        assert out.dtype == np.float32
+        assert np.allclose( out, self.reference( self.raw[0], 2.0 ),
+                            rtol=1e-5 )
+
+    def test_batch(self):
+        c = images.correction( dark=self.dark, darkoffset=12,
+                               flood=self.flood, rowblock=16 )
+        norm = np.array( [1.0, 0.5, 2.0] )
+        out = c( self.raw, norm )
+        for i in range(3):
+            assert np.allclose( out[i], self.reference( self.raw[i], norm[i] ),
+                                rtol=1e-5 )
+
+    def test_bin_flip(self):
+        c = images.correction( binning=[2, 3], flips=['Yes', 'No'] )
+        out = c( self.raw[0] )
+        assert out.shape == (50, 20)
+        expected = self.raw[0].astype(float).reshape( 50, 2, 20, 3 ).sum(
+            axis=(1, 3) )[::-1]
+        assert np.allclose( out, expected )
+
+    def test_monitor(self):
+        c = images.from_yml( { 'darkoffset' : 10 },
+                             { 'name' : 'pico6', 'value' : '1e7' } )
+        assert c.norm( { 'pico6' : '2e7' } ) == 0.5
+        out = c( self.raw[0], c.norm( { 'pico6' : '2e7' } ) )
+        assert np.allclose( out, ( self.raw[0] + 10. ) / 2 )
+        # esrf edf headers list the counters
+        h = { 'counter_mne' : 'mon sec pico6', 'counter_pos' : '3 1.0 4e7' }
+        assert c.norm( h ) == 0.25
+        self.assertRaises( KeyError, c.norm, { 'counter_mne' : 'mon' } )
+
+    def test_frames(self):
+        try:
+            import fabio.edfimage
+        except ImportError:
+            raise unittest.SkipTest( "no fabio" )
+        folder = tempfile.mkdtemp()
+        try:
+            names = []
+            for i in range(3):
+                names.append( os.path.join( folder, "f%d.edf"%(i) ) )
+                fabio.edfimage.edfimage( data = self.raw[i],
+                    header = { 'pico6' : str( 1e7 * (i+1) ) } ).write( names[-1] )
+            c = images.from_yml( { 'darkoffset' : 12 },
+                                 { 'name' : 'pico6', 'value' : 1e7 } )
+            frames = list( c.frames( names, nthreads=2, readahead=2 ) )
+            for i in range(3):
+                assert np.allclose( frames[i], ( self.raw[i] + 12. ) / (i+1) )
+        finally:
+            shutil.rmtree( folder )
+
+
+if __name__ ==  "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+
+from __future__ import print_function, division
+
+import os, unittest, tempfile, shutil, threading, time, asyncio
+import concurrent.futures
+import numpy as np
+
+from grewgg import live, projects, peaksearch
+
+
+def read_npy( filename, omega, threshold ):
+    return peaksearch.frame_peaks( np.load( filename ), threshold, omega )
+
+
+def frame( i ):
+    im = np.zeros( (16, 16) )
+    im[i % 16, 3] = 100 + i
+    return im
+
+
+class test_live( unittest.TestCase ):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.frames = [ ( i, os.path.join( self.folder, "f%04d.npy"%(i) ),
+                          0.5 * i ) for i in range(12) ]
+        self.flt = os.path.join( self.folder, "peaks.flt" )
+
+    def tearDown(self):
+        shutil.rmtree( self.folder )
+
+    def collect(self, first, last, dt=0.):
+        for i in range( first, last ):
+            np.save( self.frames[i][1], frame( i ) )
+            time.sleep( dt )
+
+    def watch(self, store, **kwds):
+        with concurrent.futures.ThreadPoolExecutor( 2 ) as pool:
+            return asyncio.run( live.watch( self.frames, read_npy, store,
+                                            executor=pool, poll=0.01,
+                                            args=( 50, ), **kwds ) )
+
+    def test_while_collecting(self):
+        t = threading.Thread( target=self.collect, args=( 0, 12, 0.01 ) )
+        t.start()
+        store = projects.peakstore( self.flt )
+        n = self.watch( store, maxinflight=3, timeout=5 )
+        t.join()
+        assert n == 12
+        pks = store.read()
+        assert np.allclose( pks['omega'], 0.5 * np.arange(12) )
+        assert np.allclose( pks['sum_intensity'], 100 + np.arange(12) )
+
+    def test_resume(self):
+        # scan stops after 5 frames
+        self.collect( 0, 5 )
+        n = self.watch( projects.peakstore( self.flt ), timeout=0.1 )
+        assert n == 5
+        # restart when the rest arrived
+        self.collect( 5, 12 )
+        store = projects.peakstore( self.flt )
+        assert store.done == 5
+        n = self.watch( store, timeout=0.1 )
+        assert n == 7
+        pks = store.read()
+        assert np.allclose( pks['sc'], np.arange(12) )
+
+    def test_existing_flt(self):
+        with open( self.flt, "w" ) as f:
+            f.write( "# offline peaks\n1 2 3\n" )
+        self.assertRaises( ValueError, projects.peakstore, self.flt )
+        assert open( self.flt ).read().startswith( "# offline" )
+        self.collect( 0, 3 )
+        n = self.watch( projects.peakstore( self.flt, restart=True ),
+                        timeout=0.1 )
+        assert n == 3
+        # a restart drops the frames already done
+        store = projects.peakstore( self.flt, restart=True )
+        assert store.done == 0
+        assert not os.path.exists( self.flt + ".done" )
+        assert len( open( self.flt ).readlines() ) == 1
+
+    def test_background_kinds(self):
+        prj = projects.project( { 'Experiment' : { 'processing' : {
+            'scan' : { 'det' : { 'Peaks' : { 'folder' : self.folder,
+                                             'fltfiles' : 'peaks.flt' } } } } } } )
+        live = prj.peakstore( 'scan', 'det', background=False )
+        assert live.filename == os.path.join( self.folder, "peaks_live.flt" )
+        live.append( 0, peaksearch.frame_peaks( frame( 0 ), 50, 0. ) )
+        final = prj.peakstore( 'scan', 'det' )
+        assert final.filename == self.flt and final.done == 0
+        final.append( 0, peaksearch.frame_peaks( frame( 0 ), 50, 0. ) )
+        # a store is not resumed with the other kind of frames
+        self.assertRaises( ValueError, projects.peakstore, self.flt,
+                           background=False )
+        assert projects.peakstore( self.flt, background=True ).done == 1
+        assert projects.peakstore( self.flt, background=False,
+                                   restart=True ).done == 0
+
+    def test_watcher_fails(self):
+        self.collect( 0, 12 )
+        arrived = live._arrived
+        async def broken( filename, poll, timeout ):
+            if filename == self.frames[4][1]:
+                raise OSError( "gone" )
+            return await arrived( filename, poll, timeout )
+        live._arrived = broken
+        try:
+            store = projects.peakstore( self.flt )
+            self.assertRaises( OSError, self.watch, store, timeout=1 )
+        finally:
+            live._arrived = arrived
+        # the frames before the failure were written
+        assert store.done == 4
+
+    def test_frames(self):
+        ymlfile = os.path.join( os.path.split( projects.__file__ )[0],
+                                "data", "fable.yml" )
+        prj = projects.project( ymlfile )
+        frames = prj.frames( "scan_2", "frelon21" )
+        assert len( frames ) == 1800
+        # collection order: all of pass 0, then pass 1
+        assert frames[1][1].endswith( "toto17_0_0001.edf.gz" )
+        assert frames[900][1].endswith( "toto17_1_0000.edf.gz" )
+        assert [ f[0] for f in frames ] == list( range( 1800 ) )
+        assert np.allclose( [ f[2] for f in frames[:3] ], [0, 0.1, 0.2] )
+        assert np.allclose( [ f[2] for f in frames[900:902] ], [0.05, 0.15] )
+        # iflip: pass 1 comes back from the end
+        images = prj.measurement( "scan_2", "frelon21" )['images']
+        images['iflip'] = 'Yes'
+        frames = prj.frames( "scan_2", "frelon21" )
+        assert frames[900][1].endswith( "toto17_1_0000.edf.gz" )
+        assert np.allclose( [ f[2] for f in frames[900:902] ],
+                            [89.95, 89.85] )
+        assert len( prj.frames( "scan_1", "frelon21" ) ) == 2
+
+
+if __name__ ==  "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+
+from __future__ import print_function, division
+
+import os, unittest, tempfile, shutil
+import numpy as np
+
+from grewgg import parfile, general_geometry
+
+TEST="./testdata"
+
+parfiles = [ os.path.join( TEST, "test%d.par"%(i) ) for i in range(5) ]
+
+
+class test_parfile( unittest.TestCase ):
+
+    def test_read(self):
+        pars = parfile.read_par_file( parfiles[0] )
+        assert pars['distance'] == 218355.233382
+        assert type( pars['o11'] ) is float
+        assert pars['cell_lattice_[P,A,B,C,I,F,R]'] == 'F'
+        assert len( pars ) == 30
+
+    def test_imaged11(self):
+        try:
+            from ImageD11 import parameters
+        except ImportError:
+            raise unittest.SkipTest( "no ImageD11" )
+        for f in parfiles:
+            ours = parfile.read_par_file( f )
+            theirs = parameters.read_par_file( f ).parameters
+            assert sorted( ours ) == sorted( theirs )
+            for k in theirs:
+                assert ours[k] == theirs[k], ( f, k )
+
+    def test_write(self):
+        pars = parfile.read_par_file( parfiles[1] )
+        folder = tempfile.mkdtemp()
+        try:
+            fname = os.path.join( folder, "out.par" )
+            parfile.write_par_file( fname, pars )
+            assert parfile.read_par_file( fname ) == pars
+        finally:
+            shutil.rmtree( folder )
+
+    def test_table(self):
+        det = general_geometry.from_yml( parfile.read_par_file( parfiles[0] ),
+                                         general_geometry.FABLE_YML,
+                                         [ "Positioners", "Fable_detector" ] )
+        table = parfile.read_par_files( parfiles, names = det.parameters() )
+        assert table['distance'].shape == (5,)
+        assert 'cell_lattice_[P,A,B,C,I,F,R]' not in parfile.read_par_files(
+            parfiles )
+        v = np.array( [ [0, 0], [10., 500.], [20., 1000.] ] )
+        xyz = det.batch( v, table )
+        for i, f in enumerate( parfiles ):
+            full = general_geometry.fable_detector( parfile.read_par_file( f ) )
+            assert np.allclose( xyz[i], full( v ) )
+        self.assertRaises( ValueError, parfile.read_par_files, parfiles,
+                           [ 'cell_lattice_[P,A,B,C,I,F,R]' ] )
+
+
+if __name__ ==  "__main__":
+    unittest.main()
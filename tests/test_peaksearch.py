@@ -0,0 +1,46 @@
+
+from __future__ import print_function, division
+
+import unittest
+import numpy as np
+
+from grewgg import peaksearch
+
+
+class test_frame_peaks( unittest.TestCase ):
+
+    def setUp(self):
+        im = np.zeros( (20, 30) )
+        im[2:4, 3:6] = 10         # block of 6
+        im[10, 29] = 5            # right edge
+        im[11, 0] = 7             # left edge, must not join the one above
+        im[15, 10] = 3
+        im[16, 11] = 3            # diagonal neighbour
+        self.im = im
+
+    def test_labels(self):
+        pk = peaksearch.frame_peaks( self.im, 1, omega=12.0 )
+        order = np.argsort( pk['sc'] )
+        npx = pk['Number_of_pixels'][order]
+        assert list( npx ) == [6, 1, 1, 2], npx
+        assert np.allclose( pk['sc'][order][0], 2.5 )
+        assert np.allclose( pk['fc'][order][0], 4.0 )
+        assert np.allclose( pk['sum_intensity'][order], [60, 5, 7, 6] )
+        assert np.allclose( pk['omega'], 12.0 )
+
+    def test_threshold(self):
+        pk = peaksearch.frame_peaks( self.im, 6 )
+        assert len( pk['sc'] ) == 2
+        pk = peaksearch.frame_peaks( self.im, 100 )
+        assert len( pk['sc'] ) == 0
+
+    def test_keys(self):
+        # a snake touching only through the ends of rows
+        keys = np.array( [0, 1, 2, 12, 13, 100] )
+        labels, n = peaksearch.label_keys( keys, [1, 10] )
+        assert n == 2
+        assert ( labels[:5] == labels[0] ).all() and labels[5] != labels[0]
+
+
+if __name__ ==  "__main__":
+    unittest.main()
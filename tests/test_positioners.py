@@ -1,5 +1,5 @@
 
-import unittest
+import os, unittest, tempfile, shutil
 import numpy as np
 
 from grewgg import positioners
@@ -121,6 +121,191 @@ class test_rot_trans( unittest.TestCase ):
         assert not np.allclose( v, vtrans ) 
         
 
+
+class test_instrument( unittest.TestCase ):
+
+    def setUp(self):
+        self.desc = [
+            { 'name' : 'distance', 'type' : 'translation', 'axis' : [1,0,0] },
+            { 'name' : 'tilt_x', 'type' : 'rotation', 'axis' : [1,0,0] },
+            { 'name' : 'tilt_y', 'type' : 'rotation', 'axis' : [0,1,0] },
+            { 'name' : 'Oij', 'type' : 'positioner',
+              'mat4' : [[1, 0, 0, 0], [0, 'o22', 'o21', 0],
+                        [0, 'o12', 'o11', 0], [0, 0, 0, 1]] },
+            { 'name' : 'y_size', 'type' : 'scale', 'axis' : [0,1,0] },
+            { 'name' : 'y_center', 'type' : 'translation', 'axis' : [0,-1,0] },
+            ]
+        self.pars = { 'distance' : 100., 'tilt_x' : 0.01, 'tilt_y' : -0.02,
+                      'o11' : 1, 'o12' : 0, 'o21' : 0, 'o22' : -1,
+                      'y_size' : 0.05, 'y_center' : 1024. }
+
+    def full(self, pars):
+        """ rebuild from scratch """
+        p = positioners.positioner( "full" )
+        for d in self.desc[::-1]:
+            p = positioners.create( d, pars ) * p
+        return p
+
+    def test_same(self):
+        inst = positioners.instrument( "test", self.desc, self.pars )
+        assert np.allclose( inst.mat4(), self.full( self.pars ).mat4() )
+        v = np.array( [ [0,0,0], [0,2,0], [0,1,3], [0,0,1] ] ).T
+        assert np.allclose( inst( v ), self.full( self.pars )( v ) )
+        assert set( inst.parameters() ) == set( self.pars.keys() )
+
+    def test_set(self):
+        inst = positioners.instrument( "test", self.desc, self.pars )
+        pars = self.pars.copy()
+        for name, value in [ ('tilt_x', 0.02), ('tilt_x', 0.03),
+                             ('distance', 120.), ('o22', 1),
+                             ('y_center', 1000.), ('tilt_y', 0.1),
+                             ('tilt_x', -0.01) ]:
+            inst.set( name, value )
+            pars[name] = value
+            assert np.allclose( inst.mat4(), self.full( pars ).mat4() ), name
+        self.assertRaises( KeyError, inst.set, 'omega', 1.0 )
+
+    def test_cached(self):
+        inst = positioners.instrument( "test", self.desc, self.pars )
+        inst.mat4()
+        inst.set( 'tilt_x', 0.02 )
+        inst.mat4()
+        k = inst.depends['tilt_x'][0]
+        b, a = inst._before[k], inst._after[k]
+        inst.set( 'tilt_x', 0.03 )
+        inst.mat4()
+        # the neighbours were reused, not recomputed
+        assert inst._before[k] is b and inst._after[k] is a
+
+    def test_mat4s(self):
+        p = np.array( [ -30., 0., 12.5, 90. ] )
+        for make in [ lambda x : positioners.rotation( 'r', [0.,1.,1.], x ),
+                      lambda x : positioners.translation( 't', [0.,1.,2.], x ),
+                      lambda x : positioners.scale( 's', [0,0,1], x ) ]:
+            m4s = make( 1.0 ).mat4s( p )
+            for pi, m in zip( p, m4s ):
+                assert np.allclose( m, make( pi ).mat4() )
+
+    def test_batch(self):
+        inst = positioners.instrument( "test", self.desc, self.pars )
+        K = 7
+        batch = { 'tilt_x' : np.linspace( -0.1, 0.1, K ),
+                  'distance' : np.linspace( 90, 110, K ),
+                  'o22' : np.array( [1,-1]*3 + [1] ),
+                  'y_size' : 0.06 }
+        v = np.array( [ [0,0,0], [0,2,0], [0,1,3], [0,0,1] ] ).T
+        m4 = inst.batch_mat4( batch )
+        xyz = inst.batch( v, batch )
+        assert m4.shape == (K,4,4) and xyz.shape == (K,3,4)
+        res = inst.batch( v, batch, observed = inst( v ) )
+        for k in range(K):
+            pars = self.pars.copy()
+            for name in batch:
+                pars[name] = np.broadcast_to( batch[name], (K,) )[k]
+            full = self.full( pars )
+            assert np.allclose( m4[k], full.mat4() )
+            assert np.allclose( xyz[k], full( v ) )
+            assert np.allclose( res[k], full( v ) - inst( v ) )
+        self.assertRaises( KeyError, inst.batch_mat4, { 'omega' : [1,2] } )
+
+    def test_positions(self):
+        desc = [ { 'name' : 'wedge', 'type' : 'rotation', 'axis' : [0,1,0] },
+                 { 'name' : 'omega', 'type' : 'rotation', 'axis' : [0,0,1] },
+                 { 'name' : 't_x', 'type' : 'translation', 'axis' : [1,0,0] } ]
+        inst = positioners.instrument( "sample", desc,
+                                       { 'wedge' : 1., 't_x' : 0.1 } )
+        rng = np.random.RandomState( 7 )
+        v = rng.normal( size = (3, 50) )
+        omega = rng.uniform( -180, 180, 50 )
+        out = inst( v, { 'omega' : omega } )
+        for i in range( 50 ):
+            pars = { 'wedge' : 1., 't_x' : 0.1, 'omega' : omega[i] }
+            full = positioners.positioner( "full" )
+            for d in desc[::-1]:
+                full = positioners.create( d, pars ) * full
+            assert np.allclose( out[:,i], full( v[:,i:i+1] )[:,0] )
+
+    def test_blocked(self):
+        inst = positioners.instrument( "test", self.desc, self.pars )
+        rng = np.random.RandomState( 8 )
+        v = rng.normal( size = (3, 1001) )
+        expected = inst( v )
+        assert np.allclose( positioners.blocked( inst, v, blocksize=64 ),
+                            expected )
+        assert np.allclose( positioners.blocked( inst, v, blocksize=64,
+                                                 nthreads=1 ), expected )
+        tilt = rng.uniform( -0.1, 0.1, 1001 )
+        expected = inst( v, { 'tilt_x' : tilt, 'distance' : 3. } )
+        got = positioners.blocked( inst, v, { 'tilt_x' : tilt,
+                                              'distance' : 3. },
+                                   blocksize=100 )
+        assert np.allclose( got, expected )
+        w = v.copy()
+        positioners.blocked( inst, w, out=w, blocksize=64 )
+        assert np.allclose( w, inst( v ) )
+
+    def test_compile_save_load(self):
+        inst = positioners.instrument( "test", self.desc, self.pars )
+        moving = [ 'tilt_x', 'distance' ]
+        comp = inst.compile( moving )
+        assert len( comp.consts ) == 3
+        assert np.allclose( comp.mat4(), inst.mat4() )
+        folder = tempfile.mkdtemp()
+        try:
+            fname = os.path.join( folder, "geometry.bin" )
+            inst.save( fname, moving )
+            loaded = positioners.load( fname )
+        finally:
+            shutil.rmtree( folder )
+        v = np.array( [ [0,0,0], [0,2,0], [0,1,3], [0,0,1] ] ).T
+        for p in ( comp, loaded ):
+            assert p.name == inst.name
+            assert np.allclose( p.mat4(), inst.mat4() )
+            assert np.allclose( p( v ), inst( v ) )
+            batch = { 'tilt_x' : np.linspace( -0.1, 0.1, 4 ) }
+            assert np.allclose( p.batch( v, batch ), inst.batch( v, batch ) )
+            assert np.allclose( p( v, batch ), inst( v, batch ) )
+            assert p.get( 'y_size' ) == self.pars['y_size']
+            self.assertRaises( KeyError, p.set, 'y_size', 1.0 )
+        loaded.set( 'distance', 200. )
+        inst.set( 'distance', 200. )
+        assert np.allclose( loaded.mat4(), inst.mat4() )
+        self.assertRaises( ValueError, inst.compile, [ 'Oij' ] )
+
+    def test_loaded_api(self):
+        # a loaded geometry has the instrument methods
+        inst = positioners.instrument( "test", self.desc, self.pars )
+        folder = tempfile.mkdtemp()
+        try:
+            fname = os.path.join( folder, "geometry.bin" )
+            inst.save( fname, [ 'tilt_x', 'distance', 'tilt_y' ] )
+            loaded = positioners.load( fname )
+            v = np.array( [ [0,0,0], [0,2,0], [0,1,3], [0,0,1] ] ).T
+            assert sorted( loaded.parameters() ) == [ 'distance', 'tilt_x',
+                                                      'tilt_y' ]
+            loaded.update( { 'distance' : 150., 'tilt_y' : 0.01 } )
+            inst.update( { 'distance' : 150., 'tilt_y' : 0.01 } )
+            assert loaded.get( 'distance' ) == 150.
+            assert np.allclose( loaded( v ), inst( v ) )
+            # the items chain gives the same matrix
+            m = np.eye(4)
+            for item in loaded.items:
+                m = np.dot( item.mat4(), m )
+            assert np.allclose( m, inst.mat4() )
+            sub = loaded.compile( [ 'distance' ] )
+            assert sub.parameters() == [ 'distance' ]
+            assert np.allclose( sub.mat4(), inst.mat4() )
+            self.assertRaises( KeyError, loaded.compile, [ 'y_size' ] )
+            batch = { 'distance' : [ 100., 200. ] }
+            assert np.allclose( sub.batch( v, batch ), inst.batch( v, batch ) )
+            loaded.save( fname, [ 'tilt_x' ] )
+            again = positioners.load( fname )
+            assert again.parameters() == [ 'tilt_x' ]
+            assert np.allclose( again.mat4(), inst.mat4() )
+            str( again )
+        finally:
+            shutil.rmtree( folder )
+
         
         
 if __name__ ==  "__main__":
@@ -0,0 +1,74 @@
+
+from __future__ import print_function, division
+
+import os, unittest, tempfile, shutil
+import concurrent.futures
+
+from grewgg import projects
+
+
+def record( prj, scan, detector, options ):
+    """ stage writing a file so we can see what ran """
+    folder = prj.stuff['folder']
+    if os.path.exists( os.path.join( folder, "fail_%s"%( detector ) ) ):
+        raise Exception( "broken" )
+    name = "%s_%s_%s"%( scan, detector, options['name'] )
+    open( os.path.join( folder, name ), "w" ).write( "done" )
+    return 10
+
+
+STAGES = dict( ( s, record ) for s in [ 'Background', 'Peaks', 'Geometry',
+                                        'Refinement' ] )
+
+
+class test_scheduler( unittest.TestCase ):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        def det( n ):
+            return { 'Background' : { 'name' : 'bg' },
+                     'Peaks' : { 'name' : 'pk' },
+                     'Geometry' : { 'name' : 'geo' } }
+        self.stuff = { 'folder' : self.folder, 'Experiment' : {
+            'processing' : {
+                'scan_1' : { 'd1' : det(1), 'd2' : det(2),
+                             'Refinement' : { 'name' : 'ref' } },
+                'scan_2' : { 'd1' : { 'Peaks' : { 'name' : 'pk' } } } } } }
+        self.state = os.path.join( self.folder, "state.yml" )
+
+    def tearDown(self):
+        shutil.rmtree( self.folder )
+
+    def test_graph(self):
+        nodes = projects.stage_graph( projects.project( self.stuff ) )
+        assert len( nodes ) == 8
+        assert nodes['scan_1/d1/Peaks'][4] == [ 'scan_1/d1/Background' ]
+        assert sorted( nodes['scan_1/Refinement'][4] ) == [
+            'scan_1/d1/Geometry', 'scan_1/d2/Geometry' ]
+        assert nodes['scan_2/d1/Peaks'][4] == []
+
+    def test_run_resume(self):
+        open( os.path.join( self.folder, "fail_d2" ), "w" ).close()
+        s = projects.scheduler( self.stuff, STAGES, statefile=self.state )
+        with concurrent.futures.ThreadPoolExecutor( 3 ) as pool:
+            report = s.run( executor=pool )
+        assert 'scan_1/d2/Background' in s.failed
+        assert len( s.done ) == 4, s.done # d1 chain and scan_2
+        assert "blocked" in report and "/s" in report
+        os.remove( os.path.join( self.folder, "fail_d2" ) )
+        os.remove( os.path.join( self.folder, "scan_1_d1_pk" ) )
+        s = projects.scheduler( self.stuff, STAGES, statefile=self.state )
+        assert len( s.done ) == 4
+        s.run( processes=2 )
+        assert len( s.done ) == 8 and not s.failed
+        # finished stages were not redone
+        assert not os.path.exists( os.path.join( self.folder, "scan_1_d1_pk" ) )
+        assert os.path.exists( os.path.join( self.folder, "scan_1_None_ref" ) )
+
+    def test_missing_stage(self):
+        self.assertRaises( KeyError, projects.scheduler, self.stuff,
+                           { 'Peaks' : record } )
+
+
+if __name__ ==  "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+
+from __future__ import print_function, division
+
+import unittest
+import numpy as np
+
+from grewgg import general_geometry, sensitivity, positioners
+
+
+def tower( name, pars ):
+    return general_geometry.from_yml( pars, general_geometry.FABLE_YML,
+                                      [ "Positioners", name ] )
+
+
+class test_displacements( unittest.TestCase ):
+
+    def setUp(self):
+        self.pars = { 'detx' : 250., 'dety' : 3., 'fz' : -2.,
+                      'fpit' : 5., 'fx' : 1. }
+        self.det = tower( "EH1_Detector_Tower", self.pars )
+        self.v = sensitivity.pixel_grid( (64, 48), step=4 ) * 0.05
+
+    def test_grids(self):
+        v = sensitivity.pixel_grid( (3, 2) )
+        assert v.shape == (3, 6)
+        assert np.allclose( v[0], 0 )
+        assert np.allclose( v[1], [0, 1, 0, 1, 0, 1] )
+        assert np.allclose( v[2], [0, 0, 1, 1, 2, 2] )
+        g = sensitivity.position_grid( [0, 1], [0, 1, 2], [5.] )
+        assert g.shape == (3, 6)
+
+    def test_translation(self):
+        d = sensitivity.displacements( self.det, self.v, [ 'detx', 'fz' ] )
+        assert d.shape == ( 2, 3, self.v.shape[1] )
+        assert np.allclose( d[0], [[1], [0], [0]] )
+        assert np.allclose( d[1], [[0], [0], [1]] )
+
+    def test_against_differences(self):
+        axes = [ 'fpit', 'dety', 'fx' ]
+        d = sensitivity.displacements( self.det, self.v, axes )
+        base = self.det( self.v )
+        for j, a in enumerate( axes ):
+            h = 1e-3
+            p = dict( self.pars )
+            p[a] += h
+            moved = tower( "EH1_Detector_Tower", p )( self.v )
+            assert np.allclose( ( moved - base ) / h, d[j], atol=1e-4 )
+
+    def test_rotation(self):
+        # hphi turns about (0,1,1) so points on that axis do not move
+        sam = tower( "EH1_Huber_Tower", { 'hphi' : 10. } )
+        g = sensitivity.position_grid( [0.], [-1., 0., 2.], [-1., 0., 2.] )
+        d = sensitivity.displacements( sam, g, [ 'hphi' ] )[0]
+        on_axis = np.abs( g[1] - g[2] ) < 1e-12
+        assert np.allclose( d[:, on_axis], 0 )
+        assert np.abs( d[:, ~on_axis] ).max() > 0.01
+
+    def test_yml_pos(self):
+        # axes not in pars sit at their yml pos
+        turn = positioners.instrument( "turn", [
+            { 'name' : 'r', 'type' : 'rotation', 'axis' : [0, 0, 1],
+              'pos' : 90. } ] )
+        assert turn.get( 'r' ) == 90.
+        assert turn.compile( [ 'r' ] ).get( 'r' ) == 90.
+        d = sensitivity.displacements( turn, [[1.], [0.], [0.]], [ 'r' ] )[0]
+        assert np.allclose( d[:, 0], [ -np.radians( 1 ), 0, 0 ] )
+
+
+class test_tolerance( unittest.TestCase ):
+
+    def test_yml_pos(self):
+        # ffdtx1 has pos : 20 in fable.yml
+        mount = tower( "FF_Detector_Mount", {} )
+        v = sensitivity.pixel_grid( (8, 8) )
+        r = sensitivity.tolerance( mount, v, { 'ffdtx1' : 0.01 },
+                                   nconfig=2000 )
+        assert np.allclose( r['rms'], 0.01, rtol=0.1 )
+
+    def test_linear(self):
+        # translations add, so the rms is the quadrature sum everywhere
+        sam = tower( "3DXRD_Huber_Tower", { 'diffrz' : 30. } )
+        g = sensitivity.position_grid( [-1, 1], [-1, 1], [0, 1] )
+        r = sensitivity.tolerance( sam, g, { 'samtx' : 0.3, 'difftz' : 0.4 },
+                                   nconfig=4000, chunk=300 )
+        assert r['rms'].shape == ( g.shape[1], )
+        assert r['config_rms'].shape == ( 4000, )
+        assert np.allclose( r['rms'], 0.5, rtol=0.05 )
+        assert ( r['max'] >= r['rms'] ).all()
+
+    def test_blocks(self):
+        # splitting configurations and points gives the same answer
+        sam = tower( "3DXRD_Huber_Tower", { 'diffrz' : 30. } )
+        g = sensitivity.position_grid( np.linspace( -1, 1, 7 ), [0., 1.],
+                                       [0., 0.5, 1.] )
+        sig = { 'diffrz' : 0.1, 'samtx' : 0.01 }
+        r1 = sensitivity.tolerance( sam, g, sig, nconfig=100 )
+        r2 = sensitivity.tolerance( sam, g, sig, nconfig=100,
+                                    maxbytes = 3 * 8 * 5 * 3 )
+        for key in r1:
+            assert np.allclose( r1[key], r2[key] ), key
+
+    def test_matches_derivatives(self):
+        # small errors: rms^2 = sum over axes of ( sigma * |d xyz/d axis| )^2
+        sam = tower( "3DXRD_Huber_Tower", { 'diffrz' : 30., 'samry' : 2. } )
+        g = sensitivity.position_grid( [-0.5, 0.5], [0., 0.5], [0.2] )
+        sig = { 'samry' : 0.01, 'diffrz' : 0.02 }
+        d = sensitivity.displacements( sam, g, list( sig ) )
+        expect = np.sqrt( sum( ( s * d[j] )**2 for j, s in
+                               enumerate( sig.values() ) ).sum( axis=0 ) )
+        r = sensitivity.tolerance( sam, g, sig, nconfig=5000, seed=3 )
+        assert np.allclose( r['rms'], expect, rtol=0.05 )
+        # repeatable with a seed
+        r2 = sensitivity.tolerance( sam, g, sig, nconfig=5000, seed=3 )
+        assert np.allclose( r['rms'], r2['rms'] )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+
+from __future__ import print_function, division
+
+import os, sys, time, unittest, multiprocessing, subprocess, tempfile, shutil
+import numpy as np
+
+from grewgg import shared, positioners
+
+
+def move( args ):
+    """ worker: apply a translation to a slice of the shared columns """
+    spec, i0, i1 = args
+    cols = shared.attach( spec )
+    t = positioners.translation( "tx", [1,0,0], 10.0 )
+    cols['xyz'][:, i0:i1] = t( cols['v'][:, i0:i1] )
+    cols.close()
+    return i1 - i0
+
+
+class test_columns( unittest.TestCase ):
+
+    def setUp(self):
+        self.v = np.arange( 3*100, dtype=float ).reshape( 3, 100 )
+
+    def test_local(self):
+        with shared.columns( { 'v' : self.v, 'omega' : self.v[0] } ) as cols:
+            assert np.allclose( cols['v'], self.v )
+            assert 'omega' in cols and len(cols) == 2
+            cols['v'][0,0] = 42
+            assert self.v[0,0] == 0
+            other = shared.attach( cols.spec() )
+            assert other['v'][0,0] == 42
+            other.close()
+            spec = cols.spec()
+        # owner removed the memory
+        self.assertRaises( FileNotFoundError, shared.attach, spec )
+
+    def test_pool(self):
+        with shared.columns( { 'v' : self.v } ) as cols:
+            cols.add( 'xyz', self.v.shape )
+            spec = cols.spec()
+            pool = multiprocessing.Pool( 2 )
+            try:
+                n = pool.map( move, [ (spec, i, i+25)
+                                      for i in range(0, 100, 25) ] )
+            finally:
+                pool.close()
+                pool.join()
+            assert sum(n) == 100
+            expected = self.v.copy()
+            expected[0] += 10
+            assert np.allclose( cols['xyz'], expected )
+
+
+# Run in a new interpreter, so the resource tracker output can be seen
+SCRIPT = """
+import os, sys, multiprocessing
+import numpy as np
+from grewgg import shared
+
+def work( spec ):
+    cols = shared.attach( spec )
+    s = float( cols['v'].sum() )
+    cols.close()
+    return s
+
+if __name__ == "__main__":
+    cols = shared.columns( { 'v' : np.ones( 1000 ) } )
+    with multiprocessing.get_context( sys.argv[1] ).Pool( 2 ) as pool:
+        assert pool.map( work, [ cols.spec() ] * 4 ) == [ 1000. ] * 4
+    print( cols.blocks['v'].name )
+    sys.stdout.flush()
+    if sys.argv[2] == "die":
+        os._exit( 0 )
+    cols.close()
+"""
+
+
+class test_lifetime( unittest.TestCase ):
+
+    def run_script(self, method, how):
+        if method not in multiprocessing.get_all_start_methods():
+            raise unittest.SkipTest( method )
+        env = dict( os.environ )
+        top = os.path.dirname( os.path.dirname( os.path.abspath(
+            shared.__file__ ) ) )
+        env['PYTHONPATH'] = os.pathsep.join( [ top, env.get( 'PYTHONPATH', '' ) ] )
+        folder = tempfile.mkdtemp()
+        try:
+            # a file, so that spawned workers can import work
+            script = os.path.join( folder, "owner.py" )
+            with open( script, "w" ) as f:
+                f.write( SCRIPT )
+            p = subprocess.run( [ sys.executable, script, method, how ],
+                                env=env, capture_output=True, text=True,
+                                timeout=60 )
+        finally:
+            shutil.rmtree( folder )
+        assert p.returncode == 0, p.stderr
+        return p.stdout.split()[-1], p.stderr
+
+    def exists(self, name, wait):
+        path = os.path.join( "/dev/shm", name.lstrip( "/" ) )
+        t0 = time.time()
+        while os.path.exists( path ) and time.time() - t0 < wait:
+            time.sleep( 0.05 )
+        return os.path.exists( path )
+
+    def test_quiet_close(self):
+        for method in ( "fork", "spawn" ):
+            name, err = self.run_script( method, "close" )
+            assert err == "", err
+            assert not self.exists( name, 0 )
+
+    def test_owner_dies(self):
+        if not os.path.isdir( "/dev/shm" ):
+            raise unittest.SkipTest( "no /dev/shm" )
+        for method in ( "fork", "spawn" ):
+            name, err = self.run_script( method, "die" )
+            # the resource tracker removes what the owner left behind
+            assert not self.exists( name, 10 ), method
+
+
+if __name__ ==  "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+
+from __future__ import print_function, division
+
+import os, unittest, tempfile, shutil
+import numpy as np
+
+from grewgg import sparseframe, peaksearch
+
+
+class test_sparse( unittest.TestCase ):
+
+    def setUp(self):
+        self.folder = os.path.join( tempfile.mkdtemp(), "sparse" )
+        rng = np.random.RandomState( 3 )
+        self.frames = []
+        for i in range( 5 ):
+            im = rng.uniform( 0, 10, (40, 30) )
+            im[10:13, 5:8] = 100 + 10 * i      # spot in every frame
+            im[20, 29] = 60
+            im[21, 0] = 60 + i                  # should not join the above
+            self.frames.append( im.astype( np.float32 ) )
+        self.omega = 0.25 * np.arange( 5 )
+        self.scan = sparseframe.write( self.folder, self.frames, self.omega, 9 )
+
+    def tearDown(self):
+        shutil.rmtree( os.path.dirname( self.folder ) )
+
+    def sort(self, pk):
+        order = np.lexsort( ( pk['fc'], pk['sc'], pk['omega'] ) )
+        return dict( ( k, pk[k][order] ) for k in pk )
+
+    def test_roundtrip(self):
+        assert self.scan.nframes == 5
+        im = self.scan.dense( 2 )
+        keep = self.frames[2] > 9
+        assert np.allclose( im[keep], self.frames[2][keep] )
+        assert ( im[~keep] == 0 ).all()
+
+    def test_same_as_dense(self):
+        for t in [ 9, 50, 105 ]:
+            dense = [ peaksearch.frame_peaks( im, t, w )
+                      for im, w in zip( self.frames, self.omega ) ]
+            dense = self.sort( dict( ( k, np.concatenate(
+                [ d[k] for d in dense ] ) ) for k in dense[0] ) )
+            sparse = self.sort( self.scan.peaks( t ) )
+            for k in dense:
+                assert np.allclose( dense[k], sparse[k] ), ( t, k )
+        self.assertRaises( AssertionError, self.scan.peaks, 5 )
+
+    def test_omega(self):
+        pk = self.scan.peaks( 50, omega_connect=True )
+        # one spot through all frames, two edge pixels through all frames
+        assert len( pk['sc'] ) == 3
+        big = np.argmax( pk['Number_of_pixels'] )
+        assert pk['Number_of_pixels'][big] == 45
+        w = 9 * ( 100 + 10 * np.arange(5) )
+        assert np.allclose( pk['omega'][big], ( w * self.omega ).sum() / w.sum() )
+        assert len( self.scan.peaks( 50, first=1, last=3 )['sc'] ) == 6
+
+
+if __name__ ==  "__main__":
+    unittest.main()